@@ -0,0 +1,78 @@
+import json
+import time
+import argparse
+from tabulate import tabulate
+
+import bner_scispacy
+
+
+class CountingCandidateGenerator:
+    """wrapper of the linker candidate generator counting the mentions it is asked to link"""
+
+    def __init__(self, candidate_generator):
+        self.candidate_generator = candidate_generator
+        self.nb_mentions = 0
+
+    def __call__(self, mention_texts, k):
+        self.nb_mentions += len(mention_texts)
+        return self.candidate_generator(mention_texts, k)
+
+
+def benchmark_model(bner_model, list_texts, link_labels):
+    """process the texts with the model pipeline linking all entities, then only the entities with link_labels.
+    Return for both runs the time, the mentions sent to the candidate generator and the links of the kept labels"""
+    dict_runs = {}
+
+    for run_name, run_labels in [("all labels", None), ("filtered", link_labels)]:
+        bner_scispacy.prepare_spacy_pipeline(bner_model, run_labels)
+        counting_generator = CountingCandidateGenerator(bner_scispacy.linker.candidate_generator)
+        bner_scispacy.linker.candidate_generator = counting_generator
+
+        time_start = time.perf_counter()
+        list_dict_results = bner_scispacy.scispacy_bner_texts(list_texts)
+        run_time = time.perf_counter() - time_start
+
+        bner_scispacy.linker.candidate_generator = counting_generator.candidate_generator
+
+        list_links = [(i, ent["char_limits"][0], ent["char_limits"][1], json.dumps(ent["rxnorm_link"]))
+                      for i, dict_result in enumerate(list_dict_results) for ent in dict_result["entities"]
+                      if ent["label"] in link_labels]
+        dict_runs[run_name] = (run_time, counting_generator.nb_mentions, list_links)
+
+    return dict_runs
+
+
+def main():
+
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--myinput', action='append', nargs=1)
+    parser.add_argument('--bnermodel', nargs='+', default=["bc5cdr", "bionlp13cg"])
+    parser.add_argument('--linklabels', nargs='+', default=["CHEMICAL", "SIMPLE_CHEMICAL"])
+    args = parser.parse_args()
+
+    #extract inputs into variables
+    file_json = args.myinput[0][0]
+    with open(file_json) as f:
+        list_cases = json.load(f)
+    list_texts = [vignette[part].replace("&lt;","<").replace("&gt;","<") for vignette in list_cases for part in ["question", "answer"]]
+
+    list_rows = []
+    for bner_model in args.bnermodel:
+        dict_runs = benchmark_model(bner_model, list_texts, args.linklabels)
+        time_all, mentions_all, links_all = dict_runs["all labels"]
+        time_filtered, mentions_filtered, links_filtered = dict_runs["filtered"]
+
+        list_rows.append((bner_model,
+                          mentions_all, mentions_filtered,
+                          "{:.2f}".format(time_all), "{:.2f}".format(time_filtered),
+                          "{:.1f}%".format(100 * (1 - time_filtered / time_all)) if time_all > 0 else "-",
+                          links_all == links_filtered))
+
+    print(tabulate(list_rows, tablefmt="fancy_grid",
+                   headers=["model", "linked mentions (all)", "linked mentions (filtered)",
+                            "time all (s)", "time filtered (s)", "saving", "same links for kept labels"]))
+
+
+if __name__ == '__main__':
+    main()
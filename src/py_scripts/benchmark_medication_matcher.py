@@ -0,0 +1,106 @@
+import spacy
+import json
+import sys
+import time
+import argparse
+from tabulate import tabulate
+
+from bner_drugbank import MATCHER_ENGINES, medication_tokens_key, load_language_model, load_vocabulary
+
+
+def match_medication_spans(doc, engine_matcher):
+    """longest matched spans of a doc as (start_char, end_char, lowercased text) triplets"""
+    list_spans = [doc[start:end] for _, start, end in engine_matcher(doc)]
+    return set([(span.start_char, span.end_char, medication_tokens_key(span)) for span in spacy.util.filter_spans(list_spans)])
+
+
+def benchmark_engine(nlp, vocab, list_docs, engine):
+    """time the build of a matcher engine and the matching over the docs, return the timings and the matched spans per doc"""
+    time_start = time.perf_counter()
+    engine_matcher, _ = MATCHER_ENGINES[engine](nlp, vocab)
+    build_time = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    list_doc_spans = [match_medication_spans(doc, engine_matcher) for doc in list_docs]
+    match_time = time.perf_counter() - time_start
+
+    return build_time, match_time, list_doc_spans
+
+
+def compare_pipeline_modes(vocab, list_texts, engine):
+    """process the texts with the full and the tokenizer-only pipelines, time it and check that 
+    the same medication spans are matched by the engine in both"""
+    dict_doc_spans = {}
+    list_rows = []
+    
+    for pipeline_mode in ["full", "tokenizer"]:
+        time_start = time.perf_counter()
+        nlp = load_language_model(pipeline_mode)
+        load_time = time.perf_counter() - time_start
+        
+        engine_matcher, _ = MATCHER_ENGINES[engine](nlp, vocab)
+        
+        time_start = time.perf_counter()
+        dict_doc_spans[pipeline_mode] = [match_medication_spans(doc, engine_matcher) for doc in nlp.pipe(list_texts)]
+        process_time = time.perf_counter() - time_start
+        
+        list_rows.append((pipeline_mode, "{:.2f}".format(load_time), "{:.1f}".format(1000 * process_time / len(list_texts))))
+    
+    print(tabulate(list_rows, tablefmt="fancy_grid", headers=["pipeline", "load (s)", "ms/text"]))
+    
+    list_differences = [i for i in range(len(list_texts)) if dict_doc_spans["full"][i] != dict_doc_spans["tokenizer"][i]]
+    print("identical matched spans in both pipelines: {} ({} texts differ)".format(len(list_differences) == 0, len(list_differences)))
+    for i in list_differences:
+        print("text {}: only in full pipeline {}, only in tokenizer pipeline {}".format(
+              i, sorted(dict_doc_spans["full"][i] - dict_doc_spans["tokenizer"][i]), sorted(dict_doc_spans["tokenizer"][i] - dict_doc_spans["full"][i])))
+    return len(list_differences) == 0
+
+
+def main():
+
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--myinput', action='append', nargs=2,  metavar=('drugbank_json','pages_json'))
+    args = parser.parse_args()
+
+    #extract inputs into variables
+    drugbank_json = args.myinput[0][0]
+    pages_json = args.myinput[0][1]
+
+    vocab = load_vocabulary(drugbank_json)
+    with open(pages_json) as f:
+        list_cases = json.load(f)
+
+    #documents are tokenized once, so that only the matching itself is timed
+    nlp = spacy.load("en_core_web_lg")
+    list_texts = [vignette[part] for vignette in list_cases for part in ["question", "answer"]]
+    list_docs = list(nlp.pipe(list_texts))
+    nb_tokens = sum([len(doc) for doc in list_docs])
+
+    dict_benchmark = {engine : benchmark_engine(nlp, vocab, list_docs, engine) for engine in MATCHER_ENGINES.keys()}
+
+    #recall of each engine relative to the spans found by any engine
+    list_all_spans = [set.union(*[dict_benchmark[engine][2][i] for engine in dict_benchmark]) for i in range(len(list_docs))]
+    nb_all_spans = sum([len(spans) for spans in list_all_spans])
+
+    list_rows = []
+    for engine, (build_time, match_time, list_doc_spans) in dict_benchmark.items():
+        nb_spans = sum([len(spans) for spans in list_doc_spans])
+        list_rows.append((engine, "{:.2f}".format(build_time), "{:.0f}".format(nb_tokens / match_time),
+                          nb_spans, "{:.3f}".format(nb_spans / nb_all_spans if nb_all_spans > 0 else 1.0)))
+
+    print(tabulate(list_rows, tablefmt="fancy_grid",
+                   headers=["engine", "build (s)", "tokens/s", "matched spans", "recall"]))
+
+    #medication only found by some of the engines, e.g. multi-word names
+    for engine, (_, _, list_doc_spans) in dict_benchmark.items():
+        list_missed = sorted(set([span[2] for i in range(len(list_docs)) for span in list_all_spans[i] - list_doc_spans[i]]))
+        print("missed by {} engine: {}".format(engine, list_missed))
+    
+    #regression check of the tokenizer-only mode against the full pipeline, failing the run when they disagree
+    if not compare_pipeline_modes(vocab, list_texts, "phrase"):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import time
+import argparse
+from tabulate import tabulate
+
+from extract_book_pages import PDF_BACKENDS, parse_pdf_content, build_vignettes_index, extract_all_cases
+
+
+def normalize_whitespace(txt):
+    """backends break lines differently, so texts are compared with runs of whitespace collapsed"""
+    return " ".join(txt.split())
+
+
+def benchmark_backend(book_pdf, backend, repeat):
+    """parse the whole book repeatedly with a backend, return the timings and the vignettes found in its pages.
+       The first run of Tika includes the start of its Java server"""
+    list_timings = []
+
+    for i in range(repeat):
+        time_start = time.perf_counter()
+        book_individual_pages = parse_pdf_content(book_pdf, backend)
+        list_timings.append(time.perf_counter() - time_start)
+
+    vignettes_index = build_vignettes_index(book_individual_pages)
+    dict_results = extract_all_cases(book_individual_pages, vignettes_index)
+
+    dict_vignettes = {case["book_page"] : (normalize_whitespace(case["question"]), normalize_whitespace(case["answer"]))
+                      for case in dict_results["vignettes"]}
+    return len(book_individual_pages), list_timings, dict_vignettes
+
+
+def main():
+
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--myinput', action='append', nargs=1)
+    parser.add_argument('--backends', nargs='+', default=list(PDF_BACKENDS.keys()), choices=list(PDF_BACKENDS.keys()))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    #extract inputs into variables
+    book_pdf = args.myinput[0][0]
+    reference_backend = args.backends[0]
+
+    dict_benchmark = {}
+    for backend in args.backends:
+        dict_benchmark[backend] = benchmark_backend(book_pdf, backend, args.repeat)
+
+    #the vignettes of the first backend are the reference for the output equivalence
+    reference_vignettes = dict_benchmark[reference_backend][2]
+
+    list_rows = []
+    for backend, (nb_pages, list_timings, dict_vignettes) in dict_benchmark.items():
+        nb_identical = len([book_page for book_page, vignette in dict_vignettes.items()
+                            if reference_vignettes.get(book_page) == vignette])
+        list_rows.append((backend, nb_pages,
+                          "{:.2f}".format(list_timings[0]),
+                          "{:.2f}".format(min(list_timings)),
+                          "{:.1f}".format(nb_pages / min(list_timings)),
+                          len(dict_vignettes),
+                          "{}/{}".format(nb_identical, len(reference_vignettes))))
+
+    print(tabulate(list_rows, tablefmt="fancy_grid",
+                   headers=["backend", "pages", "first run (s)", "best run (s)", "pages/s",
+                            "vignettes", "identical to " + reference_backend]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,29 @@
 import spacy
-from spacy.matcher import Matcher
+from spacy.matcher import Matcher, PhraseMatcher
 from spacy.tokens import Doc, Token, Span, SpanGroup
 
 
+import numpy as np
 import pandas as pd
 import json
+import hashlib
+import os
+import pickle
 import sys
 import argparse
 from tabulate import tabulate
 
+from preprocess_drugbank_vocab import load_compiled_vocab, medication_tokens_key
+
 nlp = None
 matcher = None
+matcher_engine = "phrase"
+#index medication name -> DrugBank ID, keyed by the matcher rule name for the token engine 
+#and by the lowercased tokens of the name for the phrase engine
+dict_name_to_drugbank_id = {}
+
+#single rule name under which the phrase engine registers all medication names
+PHRASE_MATCH_KEY = "MEDICATION_DRUGBANK"
 
 #register span-level extensions in Spacy
 try:
@@ -19,28 +32,188 @@ except:
     pass
 
 
-def prepare_spacy_pipeline(df_drugbank):
-    """Load English language model and insert rules into the matcher for each medication name
-    (lowercased for case insensitive matches)"""
-    global nlp
-    global matcher
+def load_vocabulary(drugbank_file, with_synonyms = False):
+    """medication entries of the vocabulary, the JSON or the compiled (.pkl) output of preprocess_drugbank_vocab.py, 
+    as parallel lists of DrugBank IDs and names. The compiled one also brings its normalized name -> DrugBank ID map 
+    and, when asked, its synonyms as further entries after all the common names"""
+    if not drugbank_file.endswith(".pkl"):
+        if with_synonyms:
+            raise ValueError("the synonyms are only kept in the compiled vocabulary (.pkl), not in " + drugbank_file)
+        df_drugbank = pd.read_json(drugbank_file, orient = "records")
+        return {"drugbank_ids" : df_drugbank["DrugBank ID"].tolist(), 
+                "names" : [str(medication_name) for medication_name in df_drugbank["Common name"]]}
     
-    nlp = spacy.load("en_core_web_lg")
-    matcher = Matcher(nlp.vocab)
+    compiled_vocab = load_compiled_vocab(drugbank_file)
+    vocab = {"drugbank_ids" : compiled_vocab["drugbank_ids"], 
+             "names" : compiled_vocab["names"], 
+             "name_to_id" : compiled_vocab["name_to_id"]}
+    if with_synonyms:
+        list_synonyms = [(drugbank_id, syn) for drugbank_id, list_syn in zip(compiled_vocab["drugbank_ids"], compiled_vocab["synonyms"]) 
+                         for syn in list_syn]
+        vocab["drugbank_ids"] = vocab["drugbank_ids"] + [drugbank_id for drugbank_id, _ in list_synonyms]
+        vocab["names"] = vocab["names"] + [syn for _, syn in list_synonyms]
+    return vocab
+
+
+def build_token_matcher(nlp, vocab):
+    """Matcher with one single-token rule per medication name, the rule being named after the medication"""
+    token_matcher = Matcher(nlp.vocab)
+    dict_index = {}
     
-    for i,row in df_drugbank.iterrows():
-        medication_name = str(row["Common name"])
+    for drugbank_id, medication_name in zip(vocab["drugbank_ids"], vocab["names"]):
         medication_lowercase = medication_name.lower() 
         #simple pattern (see https://spacy.io/usage/rule-based-matching#adding-patterns-attributes)
         pattern = [{"LOWER": medication_lowercase}]
-        matcher.add(medication_name, [pattern])
+        token_matcher.add(medication_name, [pattern])
+        #the first row with this name wins, as the former lookup in the dataframe did
+        dict_index.setdefault(medication_name, drugbank_id)
+    
+    return token_matcher, dict_index
+
+
+def tokenize_medication_names(nlp, vocab):
+    """tokenize all medication names in bulk, returning the pattern docs and the index keyed by their tokens. 
+    The index is the name -> id map of the compiled vocabulary, whose keys are built the same way, when there is one"""
+    list_patterns = list(nlp.tokenizer.pipe(vocab["names"], batch_size = 1000))
+    
+    if "name_to_id" in vocab:
+        return list_patterns, vocab["name_to_id"]
+    
+    dict_index = {}
+    for drugbank_id, pattern in zip(vocab["drugbank_ids"], list_patterns):
+        dict_index.setdefault(medication_tokens_key(pattern), drugbank_id)
+    
+    return list_patterns, dict_index
+
+
+def medication_keywords(list_patterns):
+    """the lowercased token hashes of the tokenized medication names, which the phrase matcher indexes, 
+    as one flat array and the offset of each name in it"""
+    list_keywords = [pattern.to_array("LOWER") for pattern in list_patterns]
+    offsets = np.cumsum([0] + [len(keyword) for keyword in list_keywords])
+    flat = np.concatenate(list_keywords) if len(list_keywords) > 0 else np.zeros(0, dtype = np.uint64)
+    return flat.astype(np.uint64), offsets
+
+
+def phrase_matcher_from_keywords(nlp, flat, offsets):
+    """PhraseMatcher on lowercased tokens holding all medication names under a single rule, 
+    filled directly with their token hashes: no Doc is created for the patterns"""
+    flat = flat.tolist()
+    phrase_matcher = PhraseMatcher(nlp.vocab, attr = "LOWER")
+    phrase_matcher.add(PHRASE_MATCH_KEY, [flat[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)])
+    return phrase_matcher
+
+
+def build_phrase_matcher(nlp, vocab):
+    """PhraseMatcher on lowercased tokens holding all medication names under a single rule, 
+    so that multi-word names also match. Names are tokenized in bulk and the index is keyed by their tokens"""
+    list_patterns, dict_index = tokenize_medication_names(nlp, vocab)
+    return phrase_matcher_from_keywords(nlp, *medication_keywords(list_patterns)), dict_index
+
+
+def file_sha256(input_file):
+    """hash of the file content"""
+    sha = hashlib.sha256()
+    with open(input_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def matcher_cache_file(drugbank_json, pipeline_mode, with_synonyms = False):
+    """the prebuilt phrase matcher is stored next to the vocabulary artifact, one file per pipeline mode and with or without synonyms"""
+    return "{}.phrase_{}{}.matcher".format(drugbank_json, pipeline_mode, "_synonyms" if with_synonyms else "")
+
+
+def tokenizer_identity(nlp):
+    """what the tokenization of the medication names depends on: the language model (name and version, 
+    or only the language for a blank pipeline) and the spaCy version"""
+    return (nlp.meta["lang"], nlp.meta["name"], nlp.meta["version"], spacy.__version__)
+
+
+def save_prebuilt_matcher(cache_file, cache_key, flat, offsets, dict_index):
+    """serialize the token hashes of the medication names held by the phrase matcher and its index, 
+    tagged with the key (vocabulary hash and tokenizer identity) they were built for"""
+    prebuilt = {"cache_key" : cache_key,
+                "keywords" : flat,
+                "offsets" : offsets,
+                "index" : dict_index}
+    
+    with open(cache_file + ".tmp", "wb") as fo:
+        pickle.dump(prebuilt, fo, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_file + ".tmp", cache_file)
+    return
+
+
+def load_prebuilt_matcher(nlp, cache_file, cache_key):
+    """restore the phrase matcher from its token hashes, without tokenizing the names again, together with its index. 
+    Return None when there is no prebuilt matcher for this vocabulary content and tokenizer"""
+    if not os.path.exists(cache_file):
+        return None
+    
+    with open(cache_file, "rb") as f:
+        prebuilt = pickle.load(f)
+    if prebuilt.get("cache_key") != cache_key:
+        return None
+    
+    return phrase_matcher_from_keywords(nlp, prebuilt["keywords"], prebuilt["offsets"]), prebuilt["index"]
+
+
+#registry of the matcher engines
+MATCHER_ENGINES = {"phrase" : build_phrase_matcher,
+                   "token" : build_token_matcher}
+
+
+def load_language_model(pipeline_mode = "full"):
+    """Load the English pipeline used for matching. The matcher rules only need tokens, so in "tokenizer" mode 
+    a blank English pipeline (same tokenizer rules, no tagger/parser/NER nor vectors) is used instead of en_core_web_lg"""
+    if pipeline_mode == "tokenizer":
+        return spacy.blank("en")
+    return spacy.load("en_core_web_lg")
+
+
+def prepare_spacy_pipeline(vocab, engine = "phrase", pipeline_mode = "full", drugbank_json = None, with_synonyms = False):
+    """Load English language model and build the medication matcher with the given engine 
+    (lowercased for case insensitive matches). Build also the index from medication name to DrugBank ID.
+    When the vocabulary file is given, the phrase matcher is reused from (or saved to) its prebuilt copy next to the file"""
+    global nlp
+    global matcher
+    global matcher_engine
+    global dict_name_to_drugbank_id
+    
+    nlp = load_language_model(pipeline_mode)
+    matcher_engine = engine
+    
+    if (engine != "phrase") or (drugbank_json is None):
+        matcher, dict_name_to_drugbank_id = MATCHER_ENGINES[engine](nlp, vocab)
+        return
+    
+    cache_file = matcher_cache_file(drugbank_json, pipeline_mode, with_synonyms)
+    cache_key = (file_sha256(drugbank_json),) + tokenizer_identity(nlp)
+    prebuilt = load_prebuilt_matcher(nlp, cache_file, cache_key)
+    
+    if prebuilt is not None:
+        matcher, dict_name_to_drugbank_id = prebuilt
+    else:
+        print("no prebuilt matcher for this vocabulary and tokenizer, building it into " + cache_file)
+        list_patterns, dict_name_to_drugbank_id = tokenize_medication_names(nlp, vocab)
+        flat, offsets = medication_keywords(list_patterns)
+        matcher = phrase_matcher_from_keywords(nlp, flat, offsets)
+        save_prebuilt_matcher(cache_file, cache_key, flat, offsets, dict_name_to_drugbank_id)
         
     return
     
     
+def lookup_drugbank_id(rule_name_matched, span):
+    """DrugBank ID of a matched span, given the name of the matcher rule that matched it"""
+    if matcher_engine == "phrase":
+        return dict_name_to_drugbank_id[medication_tokens_key(span)]
+    return dict_name_to_drugbank_id[rule_name_matched]
+
+    
 
-def deterministic_bner_clinicaltext(df_drugbank, txt, debug_flag = False):
-    """for the clinical text apply the Spacy Matcher to locate the spans
+def deterministic_bner_doc(doc, debug_flag = False):
+    """for the processed clinical text apply the Spacy Matcher to locate the spans
     that belong to the DrugBank vocabulary. Apply a filtering to retain only longest matches. 
     For each span record the DrugBank ID"""
     
@@ -48,11 +221,9 @@ def deterministic_bner_clinicaltext(df_drugbank, txt, debug_flag = False):
     
     if debug_flag is True:
         print("example clinical text:")
-        print(txt)
+        print(doc.text)
         print('----------------------------------------------------')
 
-    #for the question pat of the vignette
-    doc = nlp(txt)
     matches = matcher(doc)
     
     for match_id, start, end in matches:
@@ -61,7 +232,7 @@ def deterministic_bner_clinicaltext(df_drugbank, txt, debug_flag = False):
         #the contiguous document span 
         span = doc[start:end] 
         #lookup the DrugBank ID
-        drugbank_id = df_drugbank[df_drugbank["Common name"] == rule_name_matched]["DrugBank ID"].values[0]
+        drugbank_id = lookup_drugbank_id(rule_name_matched, span)
         #set this info in the span-level extension
         span._.drugbank_id = drugbank_id
         list_matches.append(span)
@@ -86,29 +257,38 @@ def deterministic_bner_clinicaltext(df_drugbank, txt, debug_flag = False):
     return list_medication
 
 
+def deterministic_bner_clinicaltext(vocab, txt, debug_flag = False):
+    """process the clinical text with the pipeline and extract the medication spans from it"""
+    doc = nlp(txt)
+    return deterministic_bner_doc(doc, debug_flag)
+
+
 
-def deterministic_bner_vignettes(df_drugbank, list_cases):
+def deterministic_bner_vignettes(vocab, list_cases, batch_size = 64):
     """iterate through the vignettes in a list of clinical cases and apply for each question and answer the 
-    medication entities extraction, returns a list of dicts, i.e. one dict with extracted medication entities for each vignette"""
+    medication entities extraction, returns a list of dicts, i.e. one dict with extracted medication entities for each vignette.
+    All questions and answers are streamed through nlp.pipe in batches"""
 
+    list_texts = []
+    for vignette in list_cases:
+        #preprocess html &lt and &gt that usually appear in medical laboratory  analysis results
+        txt_question = vignette["question"].replace("&lt;","<").replace("&gt;","<")      
+        txt_answer = vignette["answer"].replace("&lt;","<").replace("&gt;","<")
+        list_texts.extend([txt_question, txt_answer])
+    
+    docs = nlp.pipe(list_texts, batch_size = batch_size)
+    
     debug_flag = True
     list_results = []
     
     for i, vignette in enumerate(list_cases):
         
-        txt_question = vignette["question"]
-        txt_answer = vignette["answer"]
-        
-        #preprocess html &lt and &gt that usually appear in medical laboratory  analysis results
-        txt_question = txt_question.replace("&lt;","<").replace("&gt;","<")      
-        txt_answer = txt_answer.replace("&lt;","<").replace("&gt;","<")
-                                                                                                                  
-        list_medication_question = deterministic_bner_clinicaltext(df_drugbank, txt_question, debug_flag)
+        list_medication_question = deterministic_bner_doc(next(docs), debug_flag)
         #the following vignettes parts, without debugging prints
         debug_flag = False
-        list_medication_answer = deterministic_bner_clinicaltext(df_drugbank, txt_answer, debug_flag)
+        list_medication_answer = deterministic_bner_doc(next(docs), debug_flag)
             
-        dict_bner = {"question" : txt_question, "answer" : txt_answer , "book_page": vignette["book_page"],
+        dict_bner = {"question" : list_texts[2 * i], "answer" : list_texts[2 * i + 1] , "book_page": vignette["book_page"],
                     "bner_question": list_medication_question, "bner_answer": list_medication_answer
                     }
         list_results.append(dict_bner)
@@ -121,8 +301,18 @@ def main():
     
     #parse arguments
     parser = argparse.ArgumentParser()
+    #the vocabulary is either the JSON or the compiled (.pkl) output of preprocess_drugbank_vocab.py
     parser.add_argument('--myinput', action='append', nargs=2,  metavar=('drugbank_json','pages_json'))
     parser.add_argument('--myoutput', action='append', nargs=1)
+    parser.add_argument('--matcherengine', default="phrase", choices = list(MATCHER_ENGINES.keys()), 
+                        help="phrase: multi-word names matched in one pass, token: one single-token rule per name")
+    parser.add_argument('--pipelinemode', default="full", choices = ["full", "tokenizer"],
+                        help="full: en_core_web_lg, tokenizer: blank English pipeline, enough for the matcher")
+    parser.add_argument('--batchsize', type=int, default=64, help="number of texts per nlp.pipe batch")
+    parser.add_argument('--synonyms', action='store_true', help="also match the synonyms of the medication (compiled vocabulary only)")
+    parser.add_argument('--nomatchercache', action='store_true', help="always rebuild the phrase matcher instead of using its prebuilt copy")
+    parser.add_argument('--jsonl', action='store_true', 
+                        help="also write the results sorted by book page as JSON Lines (.jsonl), for the streaming consolidation")
     args = parser.parse_args()
     
     #extract inputs into variables
@@ -130,21 +320,30 @@ def main():
     pages_json = args.myinput[0][1] 
     target_file = args.myoutput[0][0]
     
-    df_drugbank = pd.read_json(drugbank_json, orient = "records")
+    if args.synonyms and not drugbank_json.endswith(".pkl"):
+        parser.error("--synonyms needs the compiled vocabulary (.pkl) as input")
+    
+    vocab = load_vocabulary(drugbank_json, args.synonyms)
     print("example input medication vocabulary:")
-    print(df_drugbank.head())
+    print(tabulate(list(zip(vocab["drugbank_ids"], vocab["names"]))[:5], headers=["DrugBank ID", "Common name"]))
     print('----------------------------------------------------')
     
     with open(pages_json) as f:
         list_cases = json.load(f)
         
-    _ = prepare_spacy_pipeline(df_drugbank)
+    _ = prepare_spacy_pipeline(vocab, args.matcherengine, args.pipelinemode, 
+                               drugbank_json = None if args.nomatchercache else drugbank_json, with_synonyms = args.synonyms)
     
-    list_results = deterministic_bner_vignettes(df_drugbank, list_cases)
+    list_results = deterministic_bner_vignettes(vocab, list_cases, args.batchsize)
     
     #dump outputs to json files
     with open(target_file, "w") as fo:
         json.dump(list_results, fo)
+    
+    if args.jsonl:
+        with open(os.path.splitext(target_file)[0] + ".jsonl", "w") as fo:
+            for dict_bner in sorted(list_results, key = lambda item: item["book_page"]):
+                fo.write(json.dumps(dict_bner) + "\n")
         
         
 if __name__ == '__main__':
@@ -1,9 +1,18 @@
 import spacy
+from spacy.language import Language
+from spacy.matcher import PhraseMatcher
+from spacy.tokens import Doc, Span
 from scispacy.abbreviation import AbbreviationDetector
 from scispacy.linking import EntityLinker
+from scispacy.candidate_generation import DEFAULT_PATHS
+import scispacy
 
 import pandas as pd
 import json
+import multiprocessing
+import os
+import pickle
+from collections import OrderedDict, Counter
 import sys
 import argparse
 from tabulate import tabulate
@@ -15,31 +24,246 @@ pp = pprint.PrettyPrinter(width=150, compact=True)
 
 nlp = None
 linker = None
+#config of the scispacy linker, loaded once and shared by the pipelines of all models
+LINKER_CONFIG = {"resolve_abbreviations": True, "linker_name": "rxnorm"}
+linking_cache = None
 
-def prepare_spacy_pipeline(bner_model):
-    """Load the specified pretrained biomedical pipeline and add stages for abbreviation decoding and for entity linking"""
+
+class LinkingCache:
+    """LRU cache of the linker candidates per normalized mention text, wrapping the candidate generator of the linker.
+    Mentions found in the cache skip the char-3gram TF-IDF vectors and the nearest neighbours search entirely.
+    Normalization (lowercase, collapsed whitespace) doesn't change the TF-IDF vectors, so cached candidates are the same"""
+
+    def __init__(self, candidate_generator, config_key, maxsize = 100000):
+        self.candidate_generator = candidate_generator
+        self.config_key = config_key
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        #entries added while running in a worker process, to be merged by the parent process, None elsewhere
+        self.new_entries = None
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, mention_texts, k):
+        list_keys = [(" ".join(mention.lower().split()), k) for mention in mention_texts]
+        
+        #candidates of the mentions missing from the cache are generated in one batch
+        list_missing_keys = list(OrderedDict.fromkeys([key for key in list_keys if key not in self.entries]))
+        dict_found = {}
+        if len(list_missing_keys) > 0:
+            batch_candidates = self.candidate_generator([key[0] for key in list_missing_keys], k)
+            dict_found = dict(zip(list_missing_keys, batch_candidates))
+        
+        batch_candidates = []
+        set_counted = set()
+        for key in list_keys:
+            if key in dict_found:
+                #repeated mentions within the batch are generated once, only the first one is a miss
+                if key in set_counted:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    set_counted.add(key)
+                batch_candidates.append(dict_found[key])
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                batch_candidates.append(self.entries[key])
+        
+        for key, candidates in dict_found.items():
+            self.add(key, candidates)
+        
+        return batch_candidates
+
+    def add(self, key, candidates):
+        self.entries[key] = candidates
+        self.entries.move_to_end(key)
+        if self.new_entries is not None:
+            self.new_entries[key] = candidates
+            if len(self.new_entries) > self.maxsize:
+                del self.new_entries[next(iter(self.new_entries))]
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+
+    def stats(self):
+        nb_lookups = self.hits + self.misses
+        return {"hits" : self.hits, "misses" : self.misses, "size" : len(self.entries),
+                "hit_rate" : self.hits / nb_lookups if nb_lookups > 0 else 0.0}
+
+    def load(self, cache_file):
+        """load the entries persisted on disk, unless they were made with another linker config"""
+        if not os.path.exists(cache_file):
+            return
+        with open(cache_file, "rb") as f:
+            persisted = pickle.load(f)
+        if persisted["config"] == self.config_key:
+            for key, candidates in persisted["entries"]:
+                self.entries[key] = candidates
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+
+    def save(self, cache_file):
+        with open(cache_file + ".tmp", "wb") as fo:
+            pickle.dump({"config" : self.config_key, "entries" : list(self.entries.items())}, fo, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + ".tmp", cache_file)
+
+
+def linking_config_key():
+    """identity of what the cached candidates depend on: the scispacy release, the KB and ANN index of the linker 
+    (the paths of their release and their sizes) and the linker config, k and the thresholds and filtering options applied to the candidates"""
+    candidate_generator = linker.candidate_generator
+    linker_paths = DEFAULT_PATHS[LINKER_CONFIG["linker_name"]]
+    return {"scispacy_version" : scispacy.__version__,
+            "linker_name" : LINKER_CONFIG["linker_name"],
+            "kb" : (type(linker.kb).__name__, len(linker.kb.cui_to_entity)),
+            "ann_index" : (linker_paths.ann_index, linker_paths.tfidf_vectorizer, linker_paths.concept_aliases_list, 
+                           len(candidate_generator.ann_concept_aliases_list)),
+            "k" : linker.k,
+            "threshold" : linker.threshold,
+            "no_definition_threshold" : linker.no_definition_threshold,
+            "filter_for_definitions" : linker.filter_for_definitions,
+            "max_entities_per_mention" : linker.max_entities_per_mention}
+
+
+def enable_linking_cache(maxsize, cache_file = None):
+    """wrap the candidate generator of the (shared) linker with the linking cache, optionally persisted in cache_file"""
+    global linking_cache
+    
+    linking_cache = LinkingCache(linker.candidate_generator, linking_config_key(), maxsize)
+    if cache_file is not None:
+        linking_cache.load(cache_file)
+    linker.candidate_generator = linking_cache
+    return
+
+
+#key of the doc user data under which the entities not to be linked are kept aside during linking
+UNLINKED_ENTS_KEY = "unlinked_ents"
+
+
+@Language.factory("link_labels_filter", default_config={"labels": []})
+def create_link_labels_filter(nlp, name, labels):
+    """component placed before the linker: entities whose label is not in labels are set aside, 
+    so that the linker doesn't generate candidates for them"""
+    set_labels = set(labels)
+    
+    def link_labels_filter(doc):
+        list_unlinked = [ent for ent in doc.ents if ent.label_ not in set_labels]
+        if len(list_unlinked) > 0:
+            doc.user_data[UNLINKED_ENTS_KEY] = list_unlinked
+            doc.ents = [ent for ent in doc.ents if ent.label_ in set_labels]
+        return doc
+    
+    return link_labels_filter
+
+
+@Language.component("link_labels_restore")
+def link_labels_restore(doc):
+    """component placed after the linker: put back the entities set aside by link_labels_filter"""
+    list_unlinked = doc.user_data.pop(UNLINKED_ENTS_KEY, [])
+    if len(list_unlinked) > 0:
+        doc.ents = sorted(list(doc.ents) + list_unlinked, key = lambda ent: ent.start)
+    return doc
+
+
+class CorpusAbbreviationResolver:
+    """replacement of the abbreviation detector resolving abbreviations with a table built once for the whole book.
+    Occurrences of the short forms are found with a PhraseMatcher and get the long form of the table, 
+    set in the same extensions as the abbreviation detector (doc._.abbreviations and span._.long_form) for the linker.
+    As for the detector, the long forms are spans, the linker reading their text; each one is tokenized once"""
+
+    def __init__(self, nlp, table):
+        self.table = table
+        self.long_forms = {abbrev : nlp.make_doc(long_form)[:] for abbrev, long_form in table.items()}
+        self.matcher = PhraseMatcher(nlp.vocab, attr = "ORTH")
+        self.matcher.add("ABBREVIATION", list(nlp.tokenizer.pipe(table.keys())))
+        
+        if not Doc.has_extension("abbreviations"):
+            Doc.set_extension("abbreviations", default = [])
+        if not Span.has_extension("long_form"):
+            Span.set_extension("long_form", default = None)
+
+    def __call__(self, doc):
+        list_spans = spacy.util.filter_spans([doc[start:end] for _, start, end in self.matcher(doc)])
+        list_abbreviations = []
+        for span in list_spans:
+            if span.text in self.table:
+                span._.long_form = self.long_forms[span.text]
+                list_abbreviations.append(span)
+        doc._.abbreviations = list_abbreviations
+        return doc
+
+
+@Language.factory("corpus_abbreviation_resolver", default_config={"table": {}})
+def create_corpus_abbreviation_resolver(nlp, name, table):
+    return CorpusAbbreviationResolver(nlp, table)
+
+
+def build_abbreviation_table(list_texts, batch_size = 32):
+    """book-level pass running only the abbreviation detector of the current pipeline over all texts,
+    returning the table abbreviation -> long form (the most frequent one when an abbreviation has several definitions)"""
+    dict_counts = {}
+    
+    with nlp.select_pipes(enable = ["abbreviation_detector"]):
+        for doc in nlp.pipe(list_texts, batch_size = batch_size):
+            for abbrev in doc._.abbreviations:
+                dict_counts.setdefault(abbrev.text, Counter())[str(abbrev._.long_form)] += 1
+    
+    abbreviation_table = {abbrev : counts.most_common(1)[0][0] for abbrev, counts in dict_counts.items()}
+    return abbreviation_table
+
+
+def use_abbreviation_table(abbreviation_table):
+    """swap the abbreviation detector of the current pipeline for the resolver based on the book-level table"""
+    nlp.replace_pipe("abbreviation_detector", "corpus_abbreviation_resolver", config = {"table": abbreviation_table})
+    return
+
+
+@Language.factory("shared_scispacy_linker")
+def create_shared_linker(nlp, name):
+    """reuse the RxNorm linker already loaded for a previous model, instead of loading its index and KB again"""
+    return linker
+
+
+def prepare_spacy_pipeline(bner_model, link_labels = None, abbreviation_table = None):
+    """Load the specified pretrained biomedical pipeline and add stages for abbreviation decoding and for entity linking.
+    The linker is loaded with the first model and shared by the pipelines of the following models.
+    When link_labels is given, only entities with these labels are linked.
+    When the book-level abbreviation_table is given, abbreviations are resolved with it instead of being detected in each text"""
     global nlp
     global linker
     
+    #release the pipeline of the previous model before loading the next one
+    nlp = None
+    
     model_fullname = "en_ner_{}_md".format(bner_model)
     nlp = spacy.load(model_fullname)
-    nlp.add_pipe("abbreviation_detector")
-    nlp.add_pipe("scispacy_linker", config={"resolve_abbreviations": True, "linker_name": "rxnorm"})
-    linker = nlp.get_pipe("scispacy_linker")
+    if abbreviation_table is None:
+        nlp.add_pipe("abbreviation_detector")
+    else:
+        nlp.add_pipe("corpus_abbreviation_resolver", config = {"table": abbreviation_table})
+    if link_labels is not None:
+        nlp.add_pipe("link_labels_filter", config={"labels": list(link_labels)})
+    if linker is None:
+        nlp.add_pipe("scispacy_linker", config=LINKER_CONFIG)
+        linker = nlp.get_pipe("scispacy_linker")
+    else:
+        nlp.add_pipe("shared_scispacy_linker", name = "scispacy_linker")
+    if link_labels is not None:
+        nlp.add_pipe("link_labels_restore")
     print(nlp.pipe_names)
     return
     
     
-def scispacy_bner_clinicaltext(txt, debug_flag = False):
-    """apply the scispacy pipeline and collect extracted entities for further use"""
+def scispacy_bner_doc(doc):
+    """collect the entities and abbreviations extracted by the scispacy pipeline from a processed text"""
     list_entities = []
     list_abbrev = []
     
-    doc = nlp(txt)
     for ent in doc.ents:
         #an item of ent._.kb_ents is a tuple e.g. ('C0055856', 1.0)
+        #only the concept id and score are kept, the concept details go in the separate concepts table
         list_entities.append({"entity" : ent.text, "label": ent.label_, 
-                              "rxnorm_link" : linker.kb.cui_to_entity[ent._.kb_ents[0][0]] if len(ent._.kb_ents) > 0 else "",
+                              "rxnorm_link" : {"cui" : ent._.kb_ents[0][0], "score" : float(ent._.kb_ents[0][1])} if len(ent._.kb_ents) > 0 else "",
                               "char_limits": [ent.start_char, ent.end_char],
                               "token_limits" : [ent.start, ent.end]
                               })
@@ -49,37 +273,97 @@ def scispacy_bner_clinicaltext(txt, debug_flag = False):
         list_abbrev.append({"abbrev":abbrev.text, "extended": str(abbrev._.long_form)})
         
     dict_result = {"entities": list_entities, "abbrev" : list_abbrev} 
+    return dict_result
+
+
+def scispacy_bner_clinicaltext(txt, debug_flag = False):
+    """apply the scispacy pipeline and collect extracted entities for further use"""
+    doc = nlp(txt)
+    dict_result = scispacy_bner_doc(doc)
+    
     if (debug_flag is True):
         print(txt)
         print("----------------------------------------------------------")
         pp.pprint(dict_result)
 
     return dict_result   
+
+
+def scispacy_bner_texts(list_texts, batch_size = 32):
+    """stream the texts through the scispacy pipeline in batches and collect extracted entities, in the order of the texts"""
+    return [scispacy_bner_doc(doc) for doc in nlp.pipe(list_texts, batch_size = batch_size)]
+
+
+def scispacy_bner_texts_worker(list_texts, batch_size = 32):
+    """process a chunk of texts in a worker process, returning also what the chunk added to the linking cache 
+    and its hits and misses, so that the parent process can merge them"""
+    if linking_cache is None:
+        return scispacy_bner_texts(list_texts, batch_size), {}, 0, 0
     
+    linking_cache.new_entries = {}
+    hits, misses = linking_cache.hits, linking_cache.misses
+    list_results = scispacy_bner_texts(list_texts, batch_size)
+    new_entries, linking_cache.new_entries = linking_cache.new_entries, None
+    return list_results, new_entries, linking_cache.hits - hits, linking_cache.misses - misses
+
+
+def scispacy_bner_texts_parallel(list_texts, batch_size = 32, n_process = 1):
+    """split the texts in chunks processed by a pool of worker processes, each one streaming its chunk through nlp.pipe.
+    Workers are forked so they inherit the loaded pipeline and linker instead of loading them again"""
+    if n_process <= 1:
+        return scispacy_bner_texts(list_texts, batch_size)
+    
+    list_chunks = [list_texts[i: i + batch_size] for i in range(0, len(list_texts), batch_size)]
+    list_results = []
+    
+    with multiprocessing.get_context("fork").Pool(n_process) as pool:
+        #imap keeps the order of the chunks
+        for chunk_results, new_entries, hits, misses in pool.imap(scispacy_bner_texts_worker, list_chunks):
+            list_results.extend(chunk_results)
+            if linking_cache is not None:
+                for key, candidates in new_entries.items():
+                    linking_cache.add(key, candidates)
+                linking_cache.hits += hits
+                linking_cache.misses += misses
+    
+    return list_results
     
     
-def scispacy_bner_vignettes(list_cases):
+    
+def vignettes_texts(list_cases):
+    """list of the question and answer texts of each vignette, one after the other"""
+    list_texts = []
+    for vignette in list_cases:
+        #preprocess html &lt and &gt that usually appear in medical laboratory  analysis results
+        txt_question = vignette["question"].replace("&lt;","<").replace("&gt;","<")      
+        txt_answer = vignette["answer"].replace("&lt;","<").replace("&gt;","<")
+        list_texts.extend([txt_question, txt_answer])
+    return list_texts
+
+
+def scispacy_bner_vignettes(list_cases, batch_size = 32, n_process = 1):
     """iterate through the vignettes in a list of clinical cases and apply for each question and answer the 
-    entities extraction, returns a list of dicts, i.e. one dict with extracted entities for each vignette"""
+    entities extraction, returns a list of dicts, i.e. one dict with extracted entities for each vignette.
+    All questions and answers are processed together with nlp.pipe, optionally spread over several processes"""
 
-    debug_flag = True
+    list_texts = vignettes_texts(list_cases)
+    
+    list_dict_results = scispacy_bner_texts_parallel(list_texts, batch_size, n_process)
+    
+    #debugging prints only for the first text
+    if len(list_texts) > 0:
+        print(list_texts[0])
+        print("----------------------------------------------------------")
+        pp.pprint(list_dict_results[0])
+    
     list_results = []
     
     for i, vignette in enumerate(list_cases):
         
-        txt_question = vignette["question"]
-        txt_answer = vignette["answer"]
-        
-        #preprocess html &lt and &gt that usually appear in medical laboratory  analysis results
-        txt_question = txt_question.replace("&lt;","<").replace("&gt;","<")      
-        txt_answer = txt_answer.replace("&lt;","<").replace("&gt;","<")
-                                                                                                                  
-        dict_result_question = scispacy_bner_clinicaltext(txt_question, debug_flag)
-        #the following vignettes parts, without debugging prints
-        debug_flag = False
-        dict_result_answer = scispacy_bner_clinicaltext(txt_answer, debug_flag)
+        dict_result_question = list_dict_results[2 * i]
+        dict_result_answer = list_dict_results[2 * i + 1]
             
-        dict_bner = {"question" : txt_question, "answer" : txt_answer , "book_page": vignette["book_page"],
+        dict_bner = {"question" : list_texts[2 * i], "answer" : list_texts[2 * i + 1] , "book_page": vignette["book_page"],
                      "bner_question": dict_result_question["entities"], 
                      "bner_answer": dict_result_answer["entities"], 
                      "abbrev_question": dict_result_question["abbrev"], 
@@ -90,35 +374,89 @@ def scispacy_bner_vignettes(list_cases):
     return list_results
     
     
+def build_concepts_table(list_results):
+    """deduplicated table cui -> RxNorm entity record of all concepts linked in the results, for joining against the mentions"""
+    dict_concepts = {}
+    
+    for dict_bner in list_results:
+        for ent in dict_bner["bner_question"] + dict_bner["bner_answer"]:
+            if (ent["rxnorm_link"] != "") and (ent["rxnorm_link"]["cui"] not in dict_concepts):
+                cui = ent["rxnorm_link"]["cui"]
+                dict_concepts[cui] = linker.kb.cui_to_entity[cui]._asdict()
+    
+    return dict_concepts
+    
+    
 def main():
     
     #parse arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('--myinput', action='append', nargs=1)
-    parser.add_argument('--bnermodel', action='append', nargs=1, choices = ["craft", "jnlpba", "bc5cdr", "bionlp13cg"])
+    #several models may be given, they are applied one after the other in the same process and share the RxNorm linker
+    parser.add_argument('--bnermodel', action='append', nargs='+', choices = ["craft", "jnlpba", "bc5cdr", "bionlp13cg"])
+    parser.add_argument('--batchsize', type=int, default=32, help="number of texts per nlp.pipe batch")
+    parser.add_argument('--nprocess', type=int, default=1, help="number of worker processes applying the pipeline")
+    parser.add_argument('--linklabels', nargs='+', default=None, 
+                        help="labels of the entities to link to RxNorm (e.g. CHEMICAL SIMPLE_CHEMICAL), by default all entities are linked")
+    parser.add_argument('--corpusabbrev', action='store_true', 
+                        help="detect abbreviations once over the whole input and resolve them with the resulting table in every text")
+    parser.add_argument('--linkingcachesize', type=int, default=0, help="max number of mentions in the entity linking cache, 0 disables it")
+    parser.add_argument('--linkingcache', default=None, help="file persisting the entity linking cache across runs")
+    parser.add_argument('--jsonl', action='store_true', 
+                        help="also write the results sorted by book page as JSON Lines (.jsonl), for the streaming consolidation")
     args = parser.parse_args()
     
     #extract inputs into variables
     file_json = args.myinput[0][0] 
-    bner_model = args.bnermodel[0][0]
-    file_json_output = file_json.replace(".json", "_" + bner_model + ".json") 
-
-    #register the used model name as parameter in renku
-    bner_model_param = Parameter(name="bner_model_name", value=bner_model)
+    list_bner_models = [bner_model for item in args.bnermodel for bner_model in item]
     
     #with open(file_json) as f:
     with open(Input(file_json)) as f:
         list_cases = json.load(f)
-                
-            
-    _ = prepare_spacy_pipeline(bner_model_param)
     
-    list_results =  scispacy_bner_vignettes(list_cases)
+    abbreviation_table = None
+    
+    for i, bner_model in enumerate(list_bner_models):
+        file_json_output = file_json.replace(".json", "_" + bner_model + ".json") 
+
+        #register the used model name as parameter in renku
+        param_name = "bner_model_name" if len(list_bner_models) == 1 else "bner_model_name_{}".format(i + 1)
+        bner_model_param = Parameter(name=param_name, value=bner_model)
+                
+        _ = prepare_spacy_pipeline(bner_model_param, args.linklabels, abbreviation_table)
+        
+        if args.corpusabbrev and (abbreviation_table is None):
+            #book-level pass with the detector of the first model, the table is then reused by all models
+            abbreviation_table = build_abbreviation_table(vignettes_texts(list_cases), args.batchsize)
+            use_abbreviation_table(abbreviation_table)
+            with open(Output(file_json.replace(".json", "_abbreviations.json")), "w") as fo:
+                json.dump(abbreviation_table, fo)
+        
+        if (args.linkingcachesize > 0) and (linking_cache is None):
+            enable_linking_cache(args.linkingcachesize, args.linkingcache)
+        
+        list_results =  scispacy_bner_vignettes(list_cases, args.batchsize, args.nprocess)
+        
+        #dump outputs to json files
+        #with open(file_json_output, "w") as fo:
+        with open(Output(file_json_output), "w") as fo:
+            json.dump(list_results, fo)
+        
+        if args.jsonl:
+            with open(Output(os.path.splitext(file_json_output)[0] + ".jsonl"), "w") as fo:
+                for dict_result in sorted(list_results, key = lambda item: item["book_page"]):
+                    fo.write(json.dumps(dict_result) + "\n")
+        
+        #the RxNorm records of the linked concepts, once per concept
+        file_concepts_output = file_json_output.replace(".json", "_rxnorm_concepts.json")
+        with open(Output(file_concepts_output), "w") as fo:
+            json.dump(build_concepts_table(list_results), fo)
+        
+        if linking_cache is not None:
+            print("linking cache after {}: {}".format(bner_model, linking_cache.stats()))
     
-    #dump outputs to json files
-    #with open(file_json_output, "w") as fo:
-    with open(Output(file_json_output), "w") as fo:
-        json.dump(list_results, fo)
+    if (linking_cache is not None) and (args.linkingcache is not None):
+        linking_cache.save(args.linkingcache)
    
     
     
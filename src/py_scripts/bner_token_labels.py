@@ -0,0 +1,27 @@
+import numpy as np
+
+#per-token labels of the consolidated entities (Token._.bner), stored compactly in the doc user data:
+#the table of the labels found in the doc and a packed bitmask (tokens x labels), instead of a list of 
+#(begin, end, label) triplets per token serialized with the user data of each token of the DocBin.
+#Token._.bner is the list of the label strings of a token, the token limits of the entities are in doc.spans["bner_spans"].
+#Shared by the consolidation step, which writes them, and by the steps reading the consolidated DocBin
+
+BNER_LABELS_KEY = "bner_labels"
+BNER_MASKS_KEY = "bner_label_masks"
+
+
+def set_bner_labels(doc, list_labels, masks):
+    """store in the doc the label table and the boolean matrix masks[token, label], packed 8 labels per byte"""
+    doc.user_data[BNER_LABELS_KEY] = list_labels
+    doc.user_data[BNER_MASKS_KEY] = np.packbits(masks, axis = 1).tobytes()
+    return
+
+
+def token_bner_labels(tok):
+    """getter of Token._.bner: labels of the consolidated entities a token belongs to, unpacked from the label bitmasks of its doc"""
+    list_labels = tok.doc.user_data.get(BNER_LABELS_KEY, [])
+    if len(list_labels) == 0:
+        return []
+    masks = np.frombuffer(tok.doc.user_data[BNER_MASKS_KEY], dtype = np.uint8).reshape(len(tok.doc), -1)
+    bits = np.unpackbits(masks[tok.i], count = len(list_labels))
+    return [list_labels[j] for j in np.flatnonzero(bits)]
@@ -0,0 +1,74 @@
+import subprocess
+import sys
+import os
+import time
+import argparse
+from tabulate import tabulate
+
+import drugdrug_interactions_drugbank
+
+#runs the SPARQL client of drugdrug_interactions_drugbank.py against sparql_standin_server.py made to fail on demand,
+#checking that retries recover from 429/5xx, that 4xx responses are not retried, and that timeouts and exhausted retries fail the query
+
+STANDIN_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sparql_standin_server.py")
+
+#(name, server args, client args, number of threads, expected outcome, expected retries)
+SCENARIOS = [("no failure", [], {}, 1, "ok", 0),
+             ("2 x 503", ["--failcount", "2"], {}, 1, "ok", 2),
+             ("2 x 429", ["--failcount", "2", "--failstatus", "429"], {}, 1, "ok", 2),
+             ("2 x 500, 4 threads", ["--failcount", "2", "--failstatus", "500"], {}, 4, "ok", 2),
+             ("503 beyond retries", ["--failcount", "10"], {"max_retries" : 2}, 1, "RuntimeError", 2),
+             ("400 not retried", ["--failcount", "10", "--failstatus", "400"], {}, 1, "HTTPError", 0),
+             ("timeout", ["--delay", "1.0"], {"timeout" : 0.2, "max_retries" : 1}, 1, "RuntimeError", 1)]
+
+
+def run_scenario(ddi_store, port, server_args, client_args, n_workers, list_cases):
+    """start the stand-in server with the failure options, query the interactions of the cases and
+    return the outcome (ok or the exception name), the elapsed time and the latency stats of the client"""
+    server = subprocess.Popen([sys.executable, STANDIN_SERVER, "--ddistore", ddi_store, "--port", str(port)] + server_args,
+                              stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    time.sleep(1.0)
+
+    try:
+        drugdrug_interactions_drugbank.sparql_url = "http://127.0.0.1:{}/sparql".format(port)
+        drugdrug_interactions_drugbank.sparql_client = drugdrug_interactions_drugbank.SparqlClient(**dict({"rate" : 0, "backoff" : 0.05}, **client_args))
+
+        time_start = time.perf_counter()
+        try:
+            drugdrug_interactions_drugbank.query_drugs_interactions([dict(vignette) for vignette in list_cases], "sparql", n_workers)
+            outcome = "ok"
+        except Exception as e:
+            outcome = type(e).__name__
+        elapsed = time.perf_counter() - time_start
+
+        return outcome, elapsed, drugdrug_interactions_drugbank.sparql_client.latency_stats()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ddistore', required=True, help="SQLite interactions store answering the queries of the stand-in server")
+    parser.add_argument('--drugs', nargs='+', default=["DB00682", "DB00945", "DB00001"], help="DrugBank IDs of the queried vignette")
+    parser.add_argument('--port', type=int, default=8890)
+    args = parser.parse_args()
+
+    list_cases = [{"bner_question" : [{"drugbank_id" : drugbank_id} for drugbank_id in args.drugs]}]
+
+    list_rows = []
+    all_passed = True
+    for i, (name, server_args, client_args, n_workers, expected_outcome, expected_retries) in enumerate(SCENARIOS):
+        outcome, elapsed, stats = run_scenario(args.ddistore, args.port + i, server_args, client_args, n_workers, list_cases)
+        passed = (outcome == expected_outcome) and (stats["retries"] == expected_retries)
+        all_passed = all_passed and passed
+        list_rows.append((name, outcome, stats["retries"], stats["queries"], "{:.2f}".format(elapsed), passed))
+
+    print(tabulate(list_rows, tablefmt="fancy_grid", headers=["scenario", "outcome", "retries", "successful queries", "time (s)", "as expected"]))
+    sys.exit(0 if all_passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,24 @@
 import spacy
 from spacy.tokens import Doc, Token, Span, SpanGroup, DocBin
 from intervaltree import Interval, IntervalTree
-import pyjq
 import pandas as pd
+import numpy as np
 import json
+import heapq
+import itertools
 import sys
 import argparse
 import pprint
 
+from bner_token_labels import token_bner_labels, set_bner_labels
+from docbin_shards import write_docbin_shards, iterate_docbin_docs
+
+#pyjq is only needed for ad-hoc queries over the models results
+try:
+    import pyjq
+except ImportError:
+    pyjq = None
+
 pd.options.display.max_colwidth = 0 
 pd.options.display.max_columns = None
 pd.set_option('display.width', 1000)
@@ -15,12 +26,15 @@ pp = pprint.PrettyPrinter(width=150, compact=True)
 
 nlp = None
 dict_models_results = {}
+#(model, book_page) -> the model's dict of results of the vignette on book_page
+dict_page_index = {}
 list_spacy_docs = []
 models_priority = ["drugbank", "bc5cdr", "bionlp13cg"]
 
 #register token-level and span-level extensions in Spacy
 try:
-    Token.set_extension("bner", default = []) 
+    #labels stored as per-doc bitmasks, see bner_token_labels.py
+    Token.set_extension("bner", getter = token_bner_labels) 
     Token.set_extension("IS_BODY_ORGAN", default = 0)
     Token.set_extension("IS_MEDICATION", default = 0)
     Token.set_extension("IS_DISEASE", default = 0)
@@ -56,23 +70,35 @@ def prefix_from_filename(input_file):
 
 
 
-def load_bner_onto_tokens_extension(question, book_page):
-    """Execute a PYJQ query to extract from each model's results the dict related to input book_page. 
-     Collect labels in span groups at Spacy doc level and set appropriate extensions values on tokens"""
-    doc = nlp(question)
-    doc._.BOOK_PAGE = book_page
-    doc.spans["bner_spans"] = []
-    itree = IntervalTree()
-
+def query_models_results(book_page):
+    """Execute a PYJQ query to extract from each model's results the dict related to input book_page, 
+    tagged with the model name. Kept for ad-hoc queries, the consolidation looks up dict_page_index instead"""
+    if pyjq is None:
+        raise ImportError("ad-hoc queries of the models results require the pyjq package")
+    
     #we use pyjq to make a selection over a nested json with the aim to retain from each model the dict associated with the book_page
     ## se appendix 2 in readme
     expr =  '[.  | to_entries[] |  .key as $k | .value[] += {"model" : $k}] | .[].value[] | select (.book_page == '+ str(book_page) +')'
     
     results = pyjq.all(expr, dict_models_results)
+    return results
+
+
+def load_bner_onto_tokens_extension(question, book_page, dict_page_results = None):
+    """Look up in the page index the dict of each model's results related to input book_page, unless these dicts
+     are given in dict_page_results (model -> dict), as in the streaming consolidation.
+     Collect labels in span groups at Spacy doc level and set appropriate extensions values on tokens"""
+    doc = nlp(question)
+    doc._.BOOK_PAGE = book_page
+    doc.spans["bner_spans"] = []
+    itree = IntervalTree()
     
     #we now start consolidation of entities registered at question level
     for prefix in models_priority:
-        model_result = [el for el in results if el["model"] == prefix][0]
+        if dict_page_results is None:
+            model_result = dict_page_index[(prefix, book_page)]
+        else:
+            model_result = dict_page_results[prefix]
         bner_q = model_result["bner_question"]
 
         for ent in bner_q:
@@ -87,6 +113,7 @@ def load_bner_onto_tokens_extension(question, book_page):
                 span._.IS_MEDICATION = 1
                 span._.MEDICATION_DETAILS["drugbank_id"] = ent["drugbank_id"]
             elif ("rxnorm_link" in ent) and (ent["rxnorm_link"] != ""):
+                #the link holds the concept id and score, details are in the concepts table of the model
                 span._.IS_MEDICATION = 1
                 span._.MEDICATION_DETAILS["rxnorm_link"] = ent["rxnorm_link"]
 
@@ -102,12 +129,15 @@ def load_bner_onto_tokens_extension(question, book_page):
             itree[span.start : span.end] = prefixed_label           
        
     
-    #now, for each token, query the itree to get all entities it belongs to
+    #per token bitmask of the labels of the entities it belongs to, over the table of the labels found in the doc
+    list_labels = sorted(set([interval.data for interval in itree]))
+    masks = np.zeros((len(doc), len(list_labels)), dtype = bool)
+    for interval in itree:
+        masks[interval.begin : interval.end, list_labels.index(interval.data)] = True
+    set_bner_labels(doc, list_labels, masks)
+    
     for tok in doc:
-        #entries in the response from the interval tree are triplets (istart,istop,data)
-        list_ents_of_token =  itree[tok.i]
-        list_ents_of_token_onlydata = [el[2] for el in list_ents_of_token]
-        tok._.bner.extend(list_ents_of_token)
+        list_ents_of_token_onlydata = [list_labels[j] for j in np.flatnonzero(masks[tok.i])]
         
         #promote some labels to be usable in spacy matchers later on 
         if "bionlp13cg:ORGAN" in list_ents_of_token_onlydata:
@@ -124,6 +154,7 @@ def load_bner_onto_tokens_extension(question, book_page):
 def process_input_files(list_input_files):
     """for each file containing bner results, call processing to consolidate info onto a single spacy document of the text"""
     global dict_models_results
+    global dict_page_index
     global list_spacy_docs
         
     for input_file in list_input_files:
@@ -132,6 +163,11 @@ def process_input_files(list_input_files):
         with open(input_file) as f:
             list_cases = json.load(f)
             dict_models_results[prefix] = list_cases
+    
+    #index the results of each model by book page once, instead of scanning all of them for each page
+    for prefix, list_cases in dict_models_results.items():
+        for vignette in list_cases:
+            dict_page_index[(prefix, vignette["book_page"])] = vignette
             
     
     #extract list of questions from all vignettes and create a mapping page -> vignette question
@@ -146,6 +182,38 @@ def process_input_files(list_input_files):
         list_spacy_docs.append(doc_q)
         
     return        
+
+
+def iterate_jsonl_records(input_file):
+    """read the results of a model written as JSON Lines, checking that they are sorted by book page"""
+    previous_page = None
+    with open(input_file) as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            record = json.loads(line)
+            if (previous_page is not None) and (record["book_page"] < previous_page):
+                raise ValueError("{} is not sorted by book_page".format(input_file))
+            previous_page = record["book_page"]
+            yield record
+
+
+def iterate_page_results(list_input_files):
+    """k-way merge of the JSON Lines results of the models by book page, 
+    yields for each page the dict model -> results of the vignette on this page, holding one record per model at a time"""
+    list_streams = [zip(itertools.repeat(prefix_from_filename(input_file)), iterate_jsonl_records(input_file)) 
+                    for input_file in list_input_files]
+    
+    merged = heapq.merge(*list_streams, key = lambda item: item[1]["book_page"])
+    for book_page, group in itertools.groupby(merged, key = lambda item: item[1]["book_page"]):
+        yield book_page, {prefix : record for prefix, record in group}
+
+
+def iterate_consolidated_docs(list_input_files):
+    """streaming counterpart of process_input_files, building and yielding the spacy document of one vignette at a time"""
+    for book_page, dict_page_results in iterate_page_results(list_input_files):
+        question = next(iter(dict_page_results.values()))["question"]
+        yield load_bner_onto_tokens_extension(question, book_page, dict_page_results)
             
 
     
@@ -186,6 +254,10 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--myinput', action='append', nargs="+")  #one or more files expected
     parser.add_argument('--myoutput', action='append', nargs=1)
+    parser.add_argument('--streaming', action='store_true', 
+                        help="merge the .jsonl results of the models (--jsonl of the bner steps) page by page instead of loading them whole, "
+                             "and write the output as a sharded DocBin: a directory of DocBin files of --shardsize docs each")
+    parser.add_argument('--shardsize', type=int, default=1000, help="number of docs per DocBin shard written with --streaming")
     args = parser.parse_args()
     
     #extract inputs into variables
@@ -193,19 +265,23 @@ def main():
     target_file = args.myoutput[0][0]
             
     _ = prepare_spacy_pipeline()
-
-    _ = process_input_files(list_input_files)
     
-    doc_bin = DocBin(store_user_data = True)
-    #serialize the list of Spacy docs 
-    for doc in list_spacy_docs:
-        doc_bin.add(doc)
+    if args.streaming:
+        #each doc is built from one vignette per model and the serialized docs are flushed to disk shard by shard, 
+        #so peak memory is bounded by the shard size rather than by the corpus size
+        nb_docs = write_docbin_shards(iterate_consolidated_docs(list_input_files), target_file, args.shardsize)
+        print("{} docs written in shards of {} to {}".format(nb_docs, args.shardsize, target_file))
+    else:
+        _ = process_input_files(list_input_files)
         
-    doc_bin.to_disk(target_file)
+        #serialize the list of Spacy docs
+        doc_bin = DocBin(store_user_data = True)
+        for doc in list_spacy_docs:
+            doc_bin.add(doc)
+        doc_bin.to_disk(target_file)
     
-    #verify read
-    doc_bin2 = DocBin().from_disk(target_file)
-    print_debug(list(doc_bin2.get_docs(nlp.vocab))[0])
+    #verify read, only the first doc (of the first shard) is decoded
+    print_debug(next(iterate_docbin_docs(target_file, nlp.vocab)))
     
     
     
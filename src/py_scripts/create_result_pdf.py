@@ -10,6 +10,9 @@ import os
 import argparse
 import pprint
 
+from bner_token_labels import token_bner_labels
+from docbin_shards import load_docbin
+
 pd.options.display.max_colwidth = 0 
 pd.options.display.max_columns = None
 pd.set_option('display.width', 1000)
@@ -17,12 +20,15 @@ pp = pprint.PrettyPrinter(width=150, compact=True)
 
 
 nlp = None
+#RxNorm concepts tables written by bner_scispacy, cui -> entity record
+dict_rxnorm_concepts = {}
 
 
 #register token-level and span-level extensions in Spacy
 try:
     #to deserialize docbin we need to set these again
-    Token.set_extension("bner", default = []) 
+    #labels stored as per-doc bitmasks, see bner_token_labels.py
+    Token.set_extension("bner", getter = token_bner_labels) 
     Token.set_extension("IS_BODY_ORGAN", default = 0)
     Token.set_extension("IS_MEDICATION", default = 0)
     Token.set_extension("IS_DISEASE", default = 0)
@@ -152,6 +158,11 @@ def html_medication(doc):
         if ent.label_ == "drugbank:MEDICATION_DRUGBANK":
             try:
                 rxnorm_link = ent._.MEDICATION_DETAILS["rxnorm_link"]
+                if isinstance(rxnorm_link, dict):
+                    #compact link to a concept, join it with the concepts table
+                    concept = dict_rxnorm_concepts.get(rxnorm_link["cui"], {})
+                    rxnorm_link = [rxnorm_link["cui"], concept.get("canonical_name", "-"), concept.get("aliases", "-"), 
+                                   concept.get("types", "-"), concept.get("definition") or "-"]
             except:
                 rxnorm_link = ["-","-","-","-","-"]
             
@@ -278,6 +289,7 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--myinput1_docbin', action='append', nargs=1)  
     parser.add_argument('--myinput2_ddi', action='append', nargs=1)
+    parser.add_argument('--myinput3_concepts', action='append', nargs='+', help="RxNorm concepts tables of the scispacy models")
     args = parser.parse_args()
     
     #extract inputs into variables
@@ -286,11 +298,16 @@ def main():
         
     _ = prepare_spacy_pipeline()
     
-    doc_bin = DocBin().from_disk(input1_file)
+    doc_bin = load_docbin(input1_file)
     
     with open(input2_file) as f:
         list_cases = json.load(f)        
     
+    if args.myinput3_concepts is not None:
+        for concepts_file in args.myinput3_concepts[0]:
+            with open(concepts_file) as f:
+                dict_rxnorm_concepts.update(json.load(f))
+    
     list_generated_pdf = generate_pdf_vignettes(doc_bin, list_cases)
     
     #now create a file with implicit outputs
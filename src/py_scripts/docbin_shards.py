@@ -0,0 +1,60 @@
+import os
+import glob
+from spacy.tokens import DocBin
+
+#a sharded DocBin is a directory of DocBin files holding at most shard_size docs each, in order.
+#Written by the streaming consolidation, which flushes each shard to disk as soon as it is full,
+#and read (as well as single DocBin files) by the steps reading the consolidated DocBin
+
+SHARD_FILE = "shard_{:05d}.bin"
+
+
+def docbin_shard_files(shards_dir):
+    """the shard files of a sharded DocBin, in order"""
+    return sorted(glob.glob(os.path.join(shards_dir, "shard_*.bin")))
+
+
+def write_docbin_shards(iter_docs, shards_dir, shard_size, store_user_data = True):
+    """serialize the docs into a sharded DocBin: a shard is written every shard_size docs,
+    so that the serialized docs of a single shard are held in memory at a time. Returns the number of docs written"""
+    os.makedirs(shards_dir, exist_ok = True)
+    #shards left by a previous run with more docs would be read after the new ones
+    for shard_file in docbin_shard_files(shards_dir):
+        os.remove(shard_file)
+
+    nb_docs = 0
+    nb_shards = 0
+    doc_bin = DocBin(store_user_data = store_user_data)
+    for doc in iter_docs:
+        doc_bin.add(doc)
+        nb_docs += 1
+        if len(doc_bin) == shard_size:
+            doc_bin.to_disk(os.path.join(shards_dir, SHARD_FILE.format(nb_shards)))
+            nb_shards += 1
+            doc_bin = DocBin(store_user_data = store_user_data)
+
+    if len(doc_bin) > 0:
+        doc_bin.to_disk(os.path.join(shards_dir, SHARD_FILE.format(nb_shards)))
+    return nb_docs
+
+
+def iterate_docbin_docs(docbin_path, vocab):
+    """docs of a DocBin file, or of a sharded DocBin directory decoding one shard at a time"""
+    list_files = docbin_shard_files(docbin_path) if os.path.isdir(docbin_path) else [docbin_path]
+    for docbin_file in list_files:
+        yield from DocBin().from_disk(docbin_file).get_docs(vocab)
+
+
+def load_docbin(docbin_path):
+    """DocBin of a file, or of all the shards of a sharded DocBin directory merged in order"""
+    if not os.path.isdir(docbin_path):
+        return DocBin().from_disk(docbin_path)
+
+    list_files = docbin_shard_files(docbin_path)
+    if len(list_files) == 0:
+        raise FileNotFoundError("no DocBin shard in " + docbin_path)
+
+    doc_bin = DocBin().from_disk(list_files[0])
+    for shard_file in list_files[1:]:
+        doc_bin.merge(DocBin().from_disk(shard_file))
+    return doc_bin
@@ -1,6 +1,14 @@
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
+import sqlite3
 import json
+import time
+import threading
+import statistics
+import os
+import codecs
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import argparse
 import itertools
@@ -12,40 +20,198 @@ from requests.packages.urllib3.exceptions import InsecureRequestWarning
 warnings.simplefilter('ignore',InsecureRequestWarning)
 pp = pprint.PrettyPrinter(width=150, compact=True)
 
-def postprocess_sparql_result(res_json):
-    """restructure sparql query response"""
-    result_json = []
-    
-    for item in res_json["results"]["bindings"]:
-        interaction_info = item["titleddi_str"]["value"]
-        drug1_id =  item["d1_str"]["value"]
-        drug2_id =  item["d2_str"]["value"]
-        drug1_name =  item["drug1_label_str"]["value"]
-        drug2_name =  item["drug2_label_str"]["value"]        
+sparql_url = "https://drugbank.bio2rdf.org/sparql"
+
+#connection to the local interactions store built by preprocess_drugbank_interactions.py
+ddi_store = None
+#client sending the SPARQL queries, created on first use
+sparql_client = None
+
+
+class TokenBucket:
+    """token-bucket rate limiter shared by the threads sending queries: 
+    tokens are refilled at `rate` per second up to `capacity`, each query takes one"""
+
+    def __init__(self, rate, capacity = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class SparqlClient:
+    """sends SPARQL queries over a pooled keep-alive session, with rate limiting, timeouts
+    and retries with exponential backoff on connection errors, timeouts, 429 and 5xx responses. Records per-query latency"""
+
+    def __init__(self, max_connections = 8, rate = 10.0, timeout = 60.0, max_retries = 4, backoff = 0.5):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = max_connections)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.verify = False
         
-        result_json.append({"interaction": interaction_info,
-                           "drug1_id" : drug1_id,
-                           "drug2_id" : drug2_id,
-                           "drug1_name" : drug1_name,
-                           "drug2_name" : drug2_name })                     
+        self.rate_limiter = TokenBucket(rate) if rate > 0 else None
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.nb_retries = 0
+
+    def query(self, qq):
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            
+            time_start = time.perf_counter()
+            try:
+                r = self.session.get(sparql_url, 
+                                     params={"query":qq}, 
+                                     headers={"Accept":"application/sparql-results+json"}, 
+                                     timeout = self.timeout)
+                if (r.status_code == 429) or (r.status_code >= 500):
+                    raise requests.HTTPError("{} response from {}".format(r.status_code, sparql_url))
+                r.raise_for_status()
+                res_json = json.loads(r.content)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError, ValueError) as e:
+                #4xx other than 429 won't succeed on retry
+                if isinstance(e, requests.HTTPError) and (r.status_code < 500) and (r.status_code != 429):
+                    raise
+                if attempt == self.max_retries:
+                    raise RuntimeError("SPARQL query failed after {} attempts: {}".format(attempt + 1, e))
+                with self.lock:
+                    self.nb_retries += 1
+                time.sleep(self.backoff * (2 ** attempt))
+                continue
+            
+            with self.lock:
+                self.latencies.append(time.perf_counter() - time_start)
+            return res_json
+
+    def query_stream(self, qq, chunk_size = 65536):
+        """send the query and yield the bindings of the json response as they are received, without loading the whole body.
+        Failures before the response starts are retried as in query, not the ones in the middle of the stream"""
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            
+            time_start = time.perf_counter()
+            try:
+                r = self.session.get(sparql_url, 
+                                     params={"query":qq}, 
+                                     headers={"Accept":"application/sparql-results+json"}, 
+                                     timeout = self.timeout,
+                                     stream = True)
+                if (r.status_code == 429) or (r.status_code >= 500):
+                    r.close()
+                    raise requests.HTTPError("{} response from {}".format(r.status_code, sparql_url))
+                r.raise_for_status()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                if isinstance(e, requests.HTTPError) and (r.status_code < 500) and (r.status_code != 429):
+                    raise
+                if attempt == self.max_retries:
+                    raise RuntimeError("SPARQL query failed after {} attempts: {}".format(attempt + 1, e))
+                with self.lock:
+                    self.nb_retries += 1
+                time.sleep(self.backoff * (2 ** attempt))
+                continue
+            
+            with r:
+                yield from iterate_sparql_bindings(r.iter_content(chunk_size = chunk_size))
+            with self.lock:
+                self.latencies.append(time.perf_counter() - time_start)
+            return
+
+    def latency_stats(self):
+        if len(self.latencies) == 0:
+            return {"queries" : 0, "retries" : self.nb_retries}
+        list_sorted = sorted(self.latencies)
+        return {"queries" : len(list_sorted),
+                "retries" : self.nb_retries,
+                "mean_s" : round(statistics.mean(list_sorted), 3),
+                "p50_s" : round(list_sorted[len(list_sorted) // 2], 3),
+                "p95_s" : round(list_sorted[min(len(list_sorted) - 1, int(0.95 * len(list_sorted)))], 3),
+                "max_s" : round(list_sorted[-1], 3)}
+
+def iterate_sparql_bindings(iter_chunks):
+    """incremental parser of a SPARQL results json received in chunks of bytes: 
+    yields the items of results.bindings one at a time, keeping in memory only the part of the body not yet parsed"""
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    iter_chunks = iter(iter_chunks)
+    buffer = ""
+    pos = None
     
+    while True:
+        if pos is None:
+            #skip the head of the response up to the opening bracket of the bindings list
+            start = buffer.find('"bindings"')
+            if (start >= 0) and (buffer.find("[", start) >= 0):
+                buffer = buffer[buffer.find("[", start) + 1:]
+                pos = 0
+                continue
+        else:
+            #skip the separators between bindings
+            while (pos < len(buffer)) and (buffer[pos] in " \t\r\n,"):
+                pos += 1
+            if (pos < len(buffer)) and (buffer[pos] == "]"):
+                return
+            if pos < len(buffer):
+                try:
+                    item, pos = decoder.raw_decode(buffer, pos)
+                    yield item
+                    continue
+                except json.JSONDecodeError:
+                    #the binding isn't fully received yet
+                    pass
+            buffer = buffer[pos:]
+            pos = 0
+        
+        chunk = next(iter_chunks, None)
+        if chunk is None:
+            raise ValueError("SPARQL response ended before the end of the bindings")
+        buffer += utf8_decoder.decode(chunk)
+
+
+def postprocess_sparql_binding(item):
+    """restructure one binding of the sparql query response"""
+    return {"interaction": item["titleddi_str"]["value"],
+            "drug1_id" : item["d1_str"]["value"],
+            "drug2_id" : item["d2_str"]["value"],
+            "drug1_name" : item["drug1_label_str"]["value"],
+            "drug2_name" : item["drug2_label_str"]["value"] }
+
+
+def postprocess_sparql_result(res_json):
+    """restructure sparql query response"""
+    result_json = [postprocess_sparql_binding(item) for item in res_json["results"]["bindings"]]
     return result_json
 
 
 
-def sparql_query_bio2rdf_interactions(drugbank_id1, drugbank_id2 = None, debug_flag = False):
-    """send query to Bio2RDF Virtuoso server and parse results to find out either:
-    -  all interactions for a given medication  (when drugbank_id2 = None)
-    -  interaction between a pair of specified medicines (drugbank_id1, drugbank_id2)
-    """
-    
-    sparql_url = "https://drugbank.bio2rdf.org/sparql"
+def build_interactions_query(list_ids1, list_ids2 = None):
+    """SPARQL query of the interactions between any drug of list_ids1 and any drug of list_ids2 
+    (any drug at all when list_ids2 = None), the DrugBank IDs being given in VALUES clauses"""
     
-    line_value_id1 = "VALUES ?db_drug1 {db:" + drugbank_id1 + "} ."
-    if drugbank_id2 is None:
+    line_value_id1 = "VALUES ?db_drug1 {" + " ".join(["db:" + drugbank_id for drugbank_id in list_ids1]) + "} ."
+    if list_ids2 is None:
         line_value_id2 = ""
     else:
-        line_value_id2 = "VALUES ?db_drug2 {db:" + drugbank_id2 + "} ."
+        line_value_id2 = "VALUES ?db_drug2 {" + " ".join(["db:" + drugbank_id for drugbank_id in list_ids2]) + "} ."
         
     qq = """
     PREFIX db: <http://bio2rdf.org/drugbank:>
@@ -79,46 +245,234 @@ def sparql_query_bio2rdf_interactions(drugbank_id1, drugbank_id2 = None, debug_f
     }
     OFFSET 0
     """
+    return qq
+
+
+def send_sparql_query(qq):
+    """send the query to the SPARQL endpoint and return its parsed json response"""
+    global sparql_client
+    if sparql_client is None:
+        sparql_client = SparqlClient()
     
-    #print(qq)
+    res_json = sparql_client.query(qq)
+    return res_json
+
+
+def map_queries(func, list_args, n_workers = 1):
+    """apply func to each tuple of arguments, concurrently on n_workers threads, returning the results in order"""
+    if n_workers <= 1:
+        return [func(*args) for args in list_args]
     
-    r = requests.get(sparql_url, 
-                     params={"query":qq}, 
-                     headers={"Accept":"application/sparql-results+json"}, 
-                     verify = False)
-    res_json = json.loads(r.content) 
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        return list(executor.map(lambda args: func(*args), list_args))
+
+
+def sparql_iterate_bio2rdf_interactions(drugbank_id1, drugbank_id2 = None):
+    """generator of the interactions of sparql_query_bio2rdf_interactions, parsed from the response while it is received.
+    Meant for the thousands of interactions of a medication when drugbank_id2 = None"""
+    global sparql_client
+    if sparql_client is None:
+        sparql_client = SparqlClient()
     
-    #if debug_flag is True:
-        #pp.pprint(res_json)
-        #print("--------------------------------------------------------")
+    qq = build_interactions_query([drugbank_id1], None if drugbank_id2 is None else [drugbank_id2])
+    for item in sparql_client.query_stream(qq):
+        yield postprocess_sparql_binding(item)
+
+
+def sparql_query_bio2rdf_interactions(drugbank_id1, drugbank_id2 = None, debug_flag = False):
+    """send query to Bio2RDF Virtuoso server and parse results to find out either:
+    -  all interactions for a given medication  (when drugbank_id2 = None), the response being streamed
+    -  interaction between a pair of specified medicines (drugbank_id1, drugbank_id2)
+    """
+    
+    if drugbank_id2 is None:
+        result_json = list(sparql_iterate_bio2rdf_interactions(drugbank_id1))
+    else:
+        qq = build_interactions_query([drugbank_id1], [drugbank_id2])
+        
+        #print(qq)
         
-    result_json = postprocess_sparql_result(res_json) 
-    df_result = pd.DataFrame(result_json)
+        res_json = send_sparql_query(qq)
+        
+        #if debug_flag is True:
+            #pp.pprint(res_json)
+            #print("--------------------------------------------------------")
+            
+        result_json = postprocess_sparql_result(res_json) 
     
     if debug_flag is True:    
-        print(df_result.head(5))
+        print(pd.DataFrame(result_json).head(5))
         
     return result_json
+
+
+def sparql_query_interactions_batch(list_ids, debug_flag = False):
+    """send a single query for the interactions among all the given drugs and split its results per ordered pair,
+    returning a dict (drug1_id, drug2_id) -> list of results, as sparql_query_bio2rdf_interactions(drug1_id, drug2_id) would return"""
+    
+    qq = build_interactions_query(list_ids, list_ids)
+    res_json = send_sparql_query(qq)
+    result_json = postprocess_sparql_result(res_json)
+    
+    dict_pairs_results = {}
+    for item in result_json:
+        dict_pairs_results.setdefault((item["drug1_id"], item["drug2_id"]), []).append(item)
+    
+    if debug_flag is True:    
+        print(pd.DataFrame(result_json).head(5))
+    
+    return dict_pairs_results
+    
+    
     
+
+def open_ddi_store(store_file):
+    """open the local interactions store read-only"""
+    global ddi_store
+    ddi_store = sqlite3.connect("file:{}?mode=ro".format(store_file), uri = True)
+    return
+
+
+def sqlite_query_interactions(drugbank_id1, drugbank_id2 = None, debug_flag = False):
+    """offline counterpart of sparql_query_bio2rdf_interactions, looking up the local interactions store to find out either:
+    -  all interactions for a given medication  (when drugbank_id2 = None)
+    -  interaction between a pair of specified medicines (drugbank_id1, drugbank_id2)
+    Results have the same structure, with drugbank_id1 as drug1
+    """
+    #pairs are stored once, ordered by DrugBank ID, so both orders are looked up
+    if drugbank_id2 is None:
+        rows = ddi_store.execute("""SELECT drug1_id, drug1_name, drug2_id, drug2_name, interaction FROM interactions 
+                                    WHERE drug1_id = ? OR drug2_id = ?""", (drugbank_id1, drugbank_id1)).fetchall()
+    else:
+        rows = ddi_store.execute("""SELECT drug1_id, drug1_name, drug2_id, drug2_name, interaction FROM interactions 
+                                    WHERE drug1_id = ? AND drug2_id = ?""", tuple(sorted([drugbank_id1, drugbank_id2]))).fetchall()
     
+    result_json = []
+    for drug1_id, drug1_name, drug2_id, drug2_name, interaction_info in rows:
+        if drug1_id != drugbank_id1:
+            drug1_id, drug1_name, drug2_id, drug2_name = drug2_id, drug2_name, drug1_id, drug1_name
+        
+        result_json.append({"interaction": interaction_info,
+                            "drug1_id" : drug1_id,
+                            "drug2_id" : drug2_id,
+                            "drug1_name" : drug1_name,
+                            "drug2_name" : drug2_name })
+    
+    if debug_flag is True:    
+        print(pd.DataFrame(result_json).head(5))
+    
+    return result_json
+
+
+#registry of the backends answering interactions queries
+DDI_BACKENDS = {"sparql" : sparql_query_bio2rdf_interactions,
+                "sqlite" : sqlite_query_interactions}
+
+#results of the pairs of drugs, persisted across runs, None when disabled
+pair_cache = None
+
+
+def ddi_backend_version(backend, store_file = None):
+    """identifies the source of the interactions, so that results cached from another source are not reused"""
+    if backend == "sparql":
+        return "sparql:" + sparql_url
+    return "sqlite:{}:{}".format(os.path.abspath(store_file), int(os.path.getmtime(store_file)))
+
+
+class PairCache:
+    """persistent SQLite cache of the interactions of pairs of drugs, keyed by the sorted pair and the backend version.
+    Pairs without interaction are cached too (negative caching), with their own time-to-live"""
+
+    def __init__(self, cache_file, backend_version, ttl = 30 * 24 * 3600, negative_ttl = 7 * 24 * 3600):
+        self.backend_version = backend_version
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        
+        self.con = sqlite3.connect(cache_file)
+        self.con.execute("""CREATE TABLE IF NOT EXISTS pair_results (backend_version TEXT NOT NULL, 
+                                                                    drug1_id TEXT NOT NULL, drug2_id TEXT NOT NULL,
+                                                                    results TEXT NOT NULL, nb_results INTEGER NOT NULL, 
+                                                                    created REAL NOT NULL,
+                                                                    PRIMARY KEY (backend_version, drug1_id, drug2_id))""")
+        self.con.commit()
+
+    def get(self, pair_drugs):
+        """cached results of a sorted pair, None when missing or expired"""
+        row = self.con.execute("""SELECT results, nb_results, created FROM pair_results 
+                                  WHERE backend_version = ? AND drug1_id = ? AND drug2_id = ?""", 
+                               (self.backend_version, pair_drugs[0], pair_drugs[1])).fetchone()
+        if row is not None:
+            results, nb_results, created = row
+            if time.time() - created < (self.ttl if nb_results > 0 else self.negative_ttl):
+                self.hits += 1
+                if nb_results == 0:
+                    self.negative_hits += 1
+                return json.loads(results)
+        
+        self.misses += 1
+        return None
+
+    def put_many(self, dict_pairs_results):
+        now = time.time()
+        self.con.executemany("INSERT OR REPLACE INTO pair_results VALUES (?, ?, ?, ?, ?, ?)",
+                             [(self.backend_version, pair_drugs[0], pair_drugs[1], json.dumps(result_json), len(result_json), now)
+                              for pair_drugs, result_json in dict_pairs_results.items()])
+        self.con.commit()
+
+    def stats(self):
+        nb_lookups = self.hits + self.misses
+        return {"hits" : self.hits, "negative_hits" : self.negative_hits, "misses" : self.misses,
+                "hit_rate" : self.hits / nb_lookups if nb_lookups > 0 else 0.0}
+
+
+def lookup_pair_cache(list_pairs):
+    """split the pairs into a dict of the results found in the pair cache and the list of the pairs still to query"""
+    if pair_cache is None:
+        return {}, list_pairs
     
+    dict_cached = {}
+    list_missing_pairs = []
+    for pair_drugs in list_pairs:
+        result_json = pair_cache.get(pair_drugs)
+        if result_json is None:
+            list_missing_pairs.append(pair_drugs)
+        else:
+            dict_cached[pair_drugs] = result_json
+    return dict_cached, list_missing_pairs
+
+
+def medication_pairs(medication_vignette):
+    """pairs of the unique medication ids in the question, each pair sorted by DrugBank ID"""
+    list_uniq_ids = sorted(set([item["drugbank_id"] for item in medication_vignette["bner_question"]]))
+    return list(itertools.combinations(list_uniq_ids, 2))
+
 
-def query_drugs_interactions(list_cases):
+def query_drugs_interactions(list_cases, backend = "sparql", n_workers = 1):
     """for each clinical case for which medication was annotated in a previous step of the workflow,
-       form all pairs among the medicines taken by the patient and record interactions between these drugs 
+       form all pairs among the medicines taken by the patient and record interactions between these drugs.
+       The queries of all pairs are sent concurrently by n_workers threads
     """
+    query_interactions = DDI_BACKENDS[backend]
     list_cases_augm = []
     
-    for medication_vignette in list_cases:
+    list_cases_pairs = [medication_pairs(medication_vignette) for medication_vignette in list_cases]
+    
+    #pairs shared by several vignettes are queried once, and only when not found in the pair cache
+    list_all_pairs = list(dict.fromkeys([pair_drugs for list_pairs in list_cases_pairs for pair_drugs in list_pairs]))
+    dict_pairs_results, list_missing_pairs = lookup_pair_cache(list_all_pairs)
+    
+    dict_queried = dict(zip(list_missing_pairs, map_queries(query_interactions, list_missing_pairs, n_workers)))
+    if pair_cache is not None:
+        pair_cache.put_many(dict_queried)
+    dict_pairs_results.update(dict_queried)
+    
+    for medication_vignette, list_pairs in zip(list_cases, list_cases_pairs):
         ddi = []
-        
-        #extract unique medication ids in the question
-        list_ids = [item["drugbank_id"] for item in medication_vignette["bner_question"]]
-        list_uniq_ids = list(set(list_ids))
-        #generate all combinations of the items in the set
-        list_pairs = list(itertools.combinations(list_uniq_ids, 2))
         for pair_drugs in list_pairs:
-            result_json = sparql_query_bio2rdf_interactions( pair_drugs[0], pair_drugs[1])
+            result_json = dict_pairs_results[pair_drugs]
             if (len(result_json) > 0):  
                 #since we asked for a pair, there is only one item in the list result_json
                 ddi.extend(result_json)
@@ -129,13 +483,72 @@ def query_drugs_interactions(list_cases):
     return list_cases_augm
     
     
+def query_drugs_interactions_batched(list_cases, batch_size = 1, n_workers = 1):
+    """same as query_drugs_interactions with the SPARQL backend, but sending one query for all the medication 
+       of batch_size vignettes (VALUES lists) instead of one query per pair, then splitting the results per vignette and pair.
+       The queries of the batches are sent concurrently by n_workers threads
+    """
+    list_cases_augm = []
+    
+    list_cases_pairs = [medication_pairs(medication_vignette) for medication_vignette in list_cases]
+    list_all_pairs = list(dict.fromkeys([pair_drugs for list_pairs in list_cases_pairs for pair_drugs in list_pairs]))
+    dict_pairs_results, list_missing_pairs = lookup_pair_cache(list_all_pairs)
+    set_missing_pairs = set(list_missing_pairs)
+    
+    #only the drugs of the pairs missing from the pair cache are queried
+    list_batches_pairs = []
+    for i in range(0, len(list_cases), batch_size):
+        list_batch_pairs = [pair_drugs for list_pairs in list_cases_pairs[i: i + batch_size] for pair_drugs in list_pairs 
+                            if pair_drugs in set_missing_pairs]
+        if len(list_batch_pairs) > 0:
+            list_batches_pairs.append(list_batch_pairs)
+    list_batches_ids = [sorted(set([drugbank_id for pair_drugs in list_batch_pairs for drugbank_id in pair_drugs])) 
+                        for list_batch_pairs in list_batches_pairs]
+    
+    list_batches_results = map_queries(sparql_query_interactions_batch, [(list_batch_ids,) for list_batch_ids in list_batches_ids], n_workers)
+    
+    dict_queried = {}
+    for list_batch_pairs, dict_batch_results in zip(list_batches_pairs, list_batches_results):
+        for pair_drugs in list_batch_pairs:
+            dict_queried[pair_drugs] = dict_batch_results.get(pair_drugs, [])
+    if pair_cache is not None:
+        pair_cache.put_many(dict_queried)
+    dict_pairs_results.update(dict_queried)
+    
+    for medication_vignette, list_pairs in zip(list_cases, list_cases_pairs):
+        ddi = []
+        for pair_drugs in list_pairs:
+            ddi.extend(dict_pairs_results.get(pair_drugs, []))
+        
+        medication_vignette.update({"drugdrug_interactions": ddi}) 
+        list_cases_augm.append(medication_vignette)
+
+    return list_cases_augm
+    
+    
     
 def main():
+    global sparql_url
+    global sparql_client
+    global pair_cache
     
     #parse arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('--myinput', action='append', nargs=1)
     parser.add_argument('--myoutput', action='append', nargs=1)
+    parser.add_argument('--ddibackend', default="sparql", choices = list(DDI_BACKENDS.keys()),
+                        help="sparql: Bio2RDF endpoint, sqlite: local store built by preprocess_drugbank_interactions.py")
+    parser.add_argument('--ddistore', default=None, help="SQLite interactions store, for the sqlite backend")
+    parser.add_argument('--sparqlurl', default=sparql_url, help="SPARQL endpoint, e.g. a local stand-in server for tests")
+    parser.add_argument('--sparqlbatch', type=int, default=0, 
+                        help="number of vignettes whose medication is sent in a single SPARQL query, 0 for one query per pair of drugs")
+    parser.add_argument('--sparqlworkers', type=int, default=8, help="number of SPARQL queries in flight at the same time")
+    parser.add_argument('--sparqlrate', type=float, default=10.0, help="max SPARQL queries per second, 0 for no limit")
+    parser.add_argument('--sparqltimeout', type=float, default=60.0, help="timeout of a SPARQL query in seconds")
+    parser.add_argument('--sparqlretries', type=int, default=4, help="retries of a failed SPARQL query, with exponential backoff")
+    parser.add_argument('--paircache', default=None, help="SQLite file caching the interactions of pairs of drugs across runs")
+    parser.add_argument('--paircachettl', type=float, default=30, help="days after which cached interactions are queried again")
+    parser.add_argument('--paircachenegttl', type=float, default=7, help="days after which pairs cached without interaction are queried again")
     args = parser.parse_args()
     
     #extract inputs into variables
@@ -145,7 +558,31 @@ def main():
     with open(medication_json) as f:
         list_cases = json.load(f)
     
-    list_cases_augm = query_drugs_interactions(list_cases)
+    if args.ddibackend == "sqlite":
+        if args.ddistore is None:
+            parser.error("--ddistore is required by the sqlite backend")
+        open_ddi_store(args.ddistore)
+    
+    sparql_url = args.sparqlurl
+    sparql_client = SparqlClient(max_connections = args.sparqlworkers, rate = args.sparqlrate, 
+                                 timeout = args.sparqltimeout, max_retries = args.sparqlretries)
+    
+    if args.paircache is not None:
+        pair_cache = PairCache(args.paircache, ddi_backend_version(args.ddibackend, args.ddistore),
+                               ttl = args.paircachettl * 24 * 3600, negative_ttl = args.paircachenegttl * 24 * 3600)
+    
+    if (args.ddibackend == "sparql") and (args.sparqlbatch > 0):
+        list_cases_augm = query_drugs_interactions_batched(list_cases, args.sparqlbatch, args.sparqlworkers)
+    elif args.ddibackend == "sparql":
+        list_cases_augm = query_drugs_interactions(list_cases, args.ddibackend, args.sparqlworkers)
+    else:
+        #the SQLite connection is used by a single thread
+        list_cases_augm = query_drugs_interactions(list_cases, args.ddibackend)
+    
+    if args.ddibackend == "sparql":
+        print("SPARQL queries latency:", sparql_client.latency_stats())
+    if pair_cache is not None:
+        print("pair cache:", pair_cache.stats())
     
     #dump outputs to json files
     with open(target_file, "w") as fo:
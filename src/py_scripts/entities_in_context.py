@@ -12,6 +12,9 @@ import sys
 import argparse
 import pprint
 
+from bner_token_labels import token_bner_labels
+from docbin_shards import load_docbin
+
 
 pd.options.display.max_colwidth = 0 
 pd.options.display.max_columns = None
@@ -27,7 +30,8 @@ depmatcher = None
 #register token-level and span-level extensions in Spacy
 try:
     #to deserialize docbin we need to set these again
-    Token.set_extension("bner", default = []) 
+    #labels stored as per-doc bitmasks, see bner_token_labels.py
+    Token.set_extension("bner", getter = token_bner_labels) 
     Token.set_extension("IS_BODY_ORGAN", default = 0)
     Token.set_extension("IS_MEDICATION", default = 0)
     Token.set_extension("IS_DISEASE", default = 0)
@@ -423,7 +427,7 @@ def main():
     
     _ = prepare_depmatcher()
     
-    doc_bin = DocBin().from_disk(input_file)
+    doc_bin = load_docbin(input_file)
     
     one_doc = list(doc_bin.get_docs(nlp.vocab))[0]
     deplacy.render(list(one_doc.sents)[2],BoxDrawingWidth=1,EnableCR=False,WordRight=False,CatenaAnalysis=True)
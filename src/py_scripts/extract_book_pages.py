@@ -1,37 +1,278 @@
 from tika import parser
+import tika
+import html
+import hashlib
+import mmap
+from concurrent.futures import ProcessPoolExecutor
 import json
+import os
 import sys
 import argparse
 
-def parse_pdf_content(book_pdf):
-    """extract book's PDF content as list of pages, which can be processed individually"""
+#optional pure-Python PDF backend, which doesn't need a Java runtime nor a Tika server
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+PAGE_MARKER = """<div class="page">"""
+
+
+def clean_page_markup(page_xhtml):
+    """remove the paragraph and div tags that Tika leaves inside a page of the XHTML content"""
+    return page_xhtml.replace("<p>", "").replace("</p>", "").replace("<div>", "").replace("</div>","").replace("<p />","")
+
+
+def iterate_pdf_pages_tika(book_pdf):
+    """yield the book's pages parsed by Tika, one at a time and in order. Page boundaries are located with find() 
+       on the XHTML content so that only the current page is copied and cleaned"""
 
     parsed_pdf = parser.from_file(book_pdf, xmlContent=True)
+    content = parsed_pdf['content']
+
+    body_start = content.find('<body>') + len('<body>')
+    body_end = content.find('</body>', body_start)
+    if body_end == -1:
+        body_end = len(content)
+
+    page_start = content.find(PAGE_MARKER, body_start, body_end)
+    while page_start != -1:
+        next_page_start = content.find(PAGE_MARKER, page_start + len(PAGE_MARKER), body_end)
+        page_end = body_end if next_page_start == -1 else next_page_start
+
+        yield clean_page_markup(content[page_start + len(PAGE_MARKER): page_end])
+
+        page_start = next_page_start
+
+
+def iterate_pdf_pages_pypdf(book_pdf):
+    """yield the book's pages extracted with pypdf, one at a time and in order. Characters are escaped 
+       as in the XHTML content produced by Tika (e.g. &lt; and &gt;) so that later stages see the same text"""
+    if pypdf is None:
+        raise ImportError("the pypdf backend requires the pypdf package")
 
-    body = parsed_pdf['content'].split('<body>')[1].split('</body>')[0]
-    body_without_tag = body.replace("<p>", "").replace("</p>", "").replace("<div>", "").replace("</div>","").replace("<p />","")
+    reader = pypdf.PdfReader(book_pdf)
+    for page in reader.pages:
+        yield html.escape(page.extract_text(), quote = False) + "\n"
 
-    book_individual_pages = body_without_tag.split("""<div class="page">""")[1:]
+
+#registry of the available PDF backends, each one iterating over the pages of a book
+PDF_BACKENDS = {"tika" : iterate_pdf_pages_tika,
+                "pypdf" : iterate_pdf_pages_pypdf}
+
+
+def pdf_backend_version(backend):
+    """version of the library behind a PDF backend, part of the cache key of the parsed pages"""
+    if backend == "tika":
+        return os.getenv("TIKA_VERSION", getattr(tika, "__version__", "unknown"))
+    elif backend == "pypdf":
+        return getattr(pypdf, "__version__", "unknown")
+    return "unknown"
+
+
+def iterate_pdf_pages(book_pdf, last_page = None, backend = "tika"):
+    """yield the book's pages one at a time, in order, using the given PDF backend. 
+       Iteration stops after last_page when it is specified"""
+
+    for page_id, page in enumerate(PDF_BACKENDS[backend](book_pdf)):
+        yield page
+
+        if (last_page is not None) and (page_id >= last_page):
+            return
+
+
+def parse_pdf_content(book_pdf, backend = "tika"):
+    """extract book's PDF content as list of pages, which can be processed individually"""
+    
+    book_individual_pages = list(iterate_pdf_pages(book_pdf, backend = backend))
 
     return book_individual_pages
 
+
+def parse_selected_pdf_pages(book_pdf, list_pages_to_read, backend = "tika"):
+    """extract only the pages needed by the selection (each question page and the answer page following it)
+       as a dict page_id -> page text. The book is iterated lazily and reading stops after the highest needed page"""
+
+    needed_pages = set(list_pages_to_read) | set([page_id + 1 for page_id in list_pages_to_read])
+    if len(needed_pages) == 0:
+        return {}
+    
+    book_selected_pages = {}
+    for page_id, page in enumerate(iterate_pdf_pages(book_pdf, last_page = max(needed_pages), backend = backend)):
+        if page_id in needed_pages:
+            book_selected_pages[page_id] = page
+
+    return book_selected_pages
+
+#----------------------------------------------------------------------------------
+
+def pdf_cache_key(book_pdf, backend = "tika"):
+    """content address of the parsed pages: hash of the PDF bytes combined with the backend (and its version) used to parse them"""
+    sha = hashlib.sha256()
+    with open(book_pdf, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    
+    return "{}_{}{}".format(sha.hexdigest(), backend, pdf_backend_version(backend))
+
+
+class PageStore:
+    """read-only view over the pages of a parsed book stored on disk, a pages file holding the UTF-8 text 
+       of all pages one after another and an index file holding their byte offsets. The pages file is memory-mapped
+       and a page is only decoded when it is accessed, so it can be indexed like the list of pages"""
+
+    def __init__(self, store_prefix):
+        self.store_prefix = store_prefix
+        with open(store_prefix + ".index.json") as f:
+            self.offsets = json.load(f)["offsets"]
+        
+        self._file = open(store_prefix + ".pages", "rb")
+        #mmap cannot map an empty file (a book without pages)
+        self._data = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ) if self.offsets[-1] > 0 else b""
+
+    def __reduce__(self):
+        #a worker process re-opens the store from disk instead of receiving the pages
+        return (PageStore, (self.store_prefix,))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, page_id):
+        if page_id < 0:
+            page_id += len(self)
+        if (page_id < 0) or (page_id >= len(self)):
+            raise IndexError("page index out of range")
+        return self._data[self.offsets[page_id]: self.offsets[page_id + 1]].decode("utf-8")
+
+    def __iter__(self):
+        for page_id in range(len(self)):
+            yield self[page_id]
+
+
+def build_page_store(book_pdf, store_prefix, backend = "tika"):
+    """parse the whole book and write its pages to the store files, page by page. 
+       Files are written under a temporary name and renamed at the end, so an interrupted run leaves no partial store"""
+    offsets = [0]
+
+    with open(store_prefix + ".pages.tmp", "wb") as fp:
+        for page in iterate_pdf_pages(book_pdf, backend = backend):
+            offsets.append(offsets[-1] + fp.write(page.encode("utf-8")))
+
+    with open(store_prefix + ".index.json.tmp", "w") as fi:
+        json.dump({"book_pdf": book_pdf, "offsets": offsets}, fi)
+
+    os.replace(store_prefix + ".pages.tmp", store_prefix + ".pages")
+    os.replace(store_prefix + ".index.json.tmp", store_prefix + ".index.json")
+    return
+
+
+def load_page_store(book_pdf, cache_dir, backend = "tika"):
+    """open the cached pages of the book, parsing the PDF only when this content was never parsed before with this backend"""
+    os.makedirs(cache_dir, exist_ok = True)
+    store_prefix = os.path.join(cache_dir, pdf_cache_key(book_pdf, backend))
+    
+    if not (os.path.exists(store_prefix + ".pages") and os.path.exists(store_prefix + ".index.json")):
+        print("no cached pages for {}, parsing it with {}".format(book_pdf, backend))
+        build_page_store(book_pdf, store_prefix, backend)
+    
+    return PageStore(store_prefix)
+
 #----------------------------------------------------------------------------------
 
-def extract_case(book_individual_pages, page_id):
-    """extract question on book page specified by page_id and extract its answer from the following page """
+CASE_MARKERS = {"question" : "Question:", 
+                "contributors" : "Contributors:", 
+                "answer" : "Answer:", 
+                "take_home" : " Take Home Points"}
+
+
+def page_marker_offsets(page):
+    """offsets of the vignette markers on a page (-1 for markers that don't appear), 
+       computed on the page text with newlines replaced by spaces, as used for extraction"""
+    page_oneline = page.replace("\n"," ")
+    return {name : page_oneline.find(marker) for name, marker in CASE_MARKERS.items()}
+
+
+def build_vignettes_index(book_individual_pages):
+    """scan the book once and record the marker offsets of every page, then pair each question page
+       with its answer page, i.e. the first following page with an answer marker and before the next question page"""
+    list_page_markers = [page_marker_offsets(page) for page in book_individual_pages]
+
+    list_vignettes = []
+    for page_id, markers in enumerate(list_page_markers):
+        if markers["question"] == -1:
+            continue
+
+        answer_page_id = None
+        for next_page_id in range(page_id + 1, len(list_page_markers)):
+            if list_page_markers[next_page_id]["answer"] != -1:
+                answer_page_id = next_page_id
+                break
+            if list_page_markers[next_page_id]["question"] != -1:
+                break
+        list_vignettes.append([page_id, answer_page_id])
+
+    vignettes_index = {"pages" : list_page_markers, "vignettes" : list_vignettes}
+    index_answer_pages(vignettes_index)
+    return vignettes_index
+
+
+def index_answer_pages(vignettes_index):
+    """add to the index the map question page -> paired answer page, built once per book 
+       (it isn't saved with the index, since json keys are strings)"""
+    vignettes_index["answer_pages"] = {question_page_id : answer_page_id for question_page_id, answer_page_id in vignettes_index["vignettes"]}
+    return vignettes_index
+
+
+def load_vignettes_index(book_individual_pages):
+    """get the marker-offset index of the book. For a page store the index is saved next to the pages
+       the first time it is built, so later runs neither re-parse nor re-scan the book"""
+    if not isinstance(book_individual_pages, PageStore):
+        return build_vignettes_index(book_individual_pages)
+
+    index_file = book_individual_pages.store_prefix + ".markers.json"
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            return index_answer_pages(json.load(f))
+
+    vignettes_index = build_vignettes_index(book_individual_pages)
+    with open(index_file + ".tmp", "w") as f:
+        json.dump({"pages" : vignettes_index["pages"], "vignettes" : vignettes_index["vignettes"]}, f)
+    os.replace(index_file + ".tmp", index_file)
+    return vignettes_index
+
+#----------------------------------------------------------------------------------
+
+def extract_case(book_individual_pages, page_id, vignettes_index = None, answer_page_id = None):
+    """extract question on book page specified by page_id and extract its answer from the following page, 
+       or from answer_page_id when given. When the marker-offset index of the book is given, 
+       its offsets are used instead of searching the pages"""
+    
+    if answer_page_id is None:
+        answer_page_id = page_id + 1
+    
+    if vignettes_index is None:
+        markers_question = None
+        markers_answer = None
+    else:
+        markers_question = vignettes_index["pages"][page_id]
+        markers_answer = vignettes_index["pages"][answer_page_id]
     
     page_question = book_individual_pages[page_id].replace("\n"," ")
-    page_answer = book_individual_pages[page_id + 1].replace("\n"," ")
+    page_answer = book_individual_pages[answer_page_id].replace("\n"," ")
+
+    if markers_question is None:
+        markers_question = page_marker_offsets(page_question)
+        markers_answer = page_marker_offsets(page_answer)
 
     #the question limits
-    question_start = page_question.find("Question:")
-    question_end = page_question.find("Contributors:")
+    question_start = markers_question["question"]
+    question_end = markers_question["contributors"]
 
     question_txt = page_question[question_start + len("Question:"): question_end].strip()
 
     #-- now the answer limits
-    answer_start = page_answer.find("Answer:")
-    answer_end = page_answer.find(" Take Home Points")
+    answer_start = markers_answer["answer"]
+    answer_end = markers_answer["take_home"]
 
     answer_txt = page_answer[answer_start + len("Answer:"): answer_end].strip()
 
@@ -40,17 +281,36 @@ def extract_case(book_individual_pages, page_id):
 
 #----------------------------------------------------------------------------------
 
-def extract_selected_cases(book_individual_pages, list_pages_to_read):
+def page_exists(book_individual_pages, page_id):
+    """pages are kept in a dict when only the selection was read from the book, otherwise in a list or page store"""
+    if isinstance(book_individual_pages, dict):
+        return page_id in book_individual_pages
+    return 0 <= page_id < len(book_individual_pages)
+
+
+def extract_selected_cases(book_individual_pages, list_pages_to_read, vignettes_index = None, paired_answers = False):
     """iterate the selected pages numbers in list_pages_to_read, apply processing and collect
-       results into a list of dicts. Inexistant page numbers are collected separately in a list of errors"""
+       results into a list of dicts. Inexistant page numbers are collected separately in a list of errors.
+       The answers are read from the following pages, unless paired_answers is set, then the answer pages
+       paired with the questions by the marker-offset index are used"""
 
     list_cases = []
     list_errors = []
     
     for page_id in list_pages_to_read:
+        answer_page_id = None
         try:
-            current_case = extract_case(book_individual_pages, page_id)
+            if paired_answers:
+                answer_page_id = vignettes_index["answer_pages"][page_id]
+                if answer_page_id is None:
+                    raise ValueError("no answer page found for the question on page {}".format(page_id))
+            current_case = extract_case(book_individual_pages, page_id, vignettes_index, answer_page_id)
             list_cases.append(current_case)
+        except (KeyError, IndexError):
+            #either the question page or its answer page is missing from the book
+            missing_page_id = page_id if not page_exists(book_individual_pages, page_id) else \
+                              (answer_page_id if answer_page_id is not None else page_id + 1)
+            list_errors.append({"book_page" : page_id, "error": "page {} out of range".format(missing_page_id)})
         except Exception as e:
             list_errors.append({"book_page" : page_id, "error": str(e)})
 
@@ -59,6 +319,63 @@ def extract_selected_cases(book_individual_pages, list_pages_to_read):
                    }
     return dict_results
 
+
+def extract_all_cases(book_individual_pages, vignettes_index):
+    """extract every vignette found in the book by the marker-offset index"""
+    list_pages_to_read = [question_page_id for question_page_id, _ in vignettes_index["vignettes"]]
+    return extract_selected_cases(book_individual_pages, list_pages_to_read, vignettes_index, paired_answers = True)
+
+def load_book_for_selections(book_pdf, list_selections, pages_cache = None, backend = "tika"):
+    """parse a book once for all the page selections made on it (None meaning all vignettes of the book),
+       returning its pages and marker-offset index (None when only selected pages are read)"""
+    if pages_cache is not None:
+        book_individual_pages = load_page_store(book_pdf, pages_cache, backend)
+        vignettes_index = load_vignettes_index(book_individual_pages)
+    elif any([list_pages_to_read is None for list_pages_to_read in list_selections]):
+        book_individual_pages = parse_pdf_content(book_pdf, backend)
+        vignettes_index = build_vignettes_index(book_individual_pages)
+    else:
+        #only the pages needed by any of the selections are kept in memory
+        all_pages_to_read = sorted(set([page_id for list_pages_to_read in list_selections for page_id in list_pages_to_read]))
+        book_individual_pages = parse_selected_pdf_pages(book_pdf, all_pages_to_read, backend)
+        vignettes_index = None
+    
+    return book_individual_pages, vignettes_index
+
+
+def extract_batch(list_jobs, pages_cache = None, n_workers = 1, backend = "tika"):
+    """process a list of (book_pdf, list_pages_to_read) jobs, parsing each book only once and fanning out
+       the extraction of the selections over a pool of worker processes. Returns one dict of results per job, in order"""
+    list_books = []
+    for book_pdf, _ in list_jobs:
+        if book_pdf not in list_books:
+            list_books.append(book_pdf)
+    
+    executor = ProcessPoolExecutor(max_workers = n_workers) if n_workers > 1 else None
+    list_results = [None] * len(list_jobs)
+    
+    for book_pdf in list_books:
+        list_job_ids = [job_id for job_id, job in enumerate(list_jobs) if job[0] == book_pdf]
+        list_selections = [list_jobs[job_id][1] for job_id in list_job_ids]
+        book_individual_pages, vignettes_index = load_book_for_selections(book_pdf, list_selections, pages_cache, backend)
+        
+        for job_id, list_pages_to_read in zip(list_job_ids, list_selections):
+            if list_pages_to_read is None:
+                func, func_args = extract_all_cases, (book_individual_pages, vignettes_index)
+            else:
+                func, func_args = extract_selected_cases, (book_individual_pages, list_pages_to_read, vignettes_index)
+            
+            if executor is None:
+                list_results[job_id] = func(*func_args)
+            else:
+                list_results[job_id] = executor.submit(func, *func_args)
+    
+    if executor is not None:
+        list_results = [future.result() for future in list_results]
+        executor.shutdown()
+    
+    return list_results
+
 #----------------------------------------------------------------------------------
 
 def main():
@@ -66,37 +383,57 @@ def main():
         
     #parse arguments
     parser = argparse.ArgumentParser()
-    parser.add_argument('--myinput', action='append', nargs=2,  metavar=('bookpdf','selected_pages'))
+    #the selected pages file is optional, without it all vignettes of the book are extracted
+    parser.add_argument('--myinput', action='append', nargs='+',  metavar='bookpdf [selected_pages]')
     parser.add_argument('--myoutput', action='append', nargs=1)
     parser.add_argument('--errors', action='append', nargs=1)
+    parser.add_argument('--pagescache', default=None, help="folder of the on-disk store of parsed book pages, reused across runs")
+    parser.add_argument('--workers', type=int, default=1, help="number of processes extracting the selections in batch mode")
+    parser.add_argument('--pdfbackend', default="tika", choices = list(PDF_BACKENDS.keys()), help="library used to extract the text of the PDF pages")
     args = parser.parse_args()
     
     #print(args) ###Namespace(errors=[['data/errors/errors_selection1.json']], myinput=[['data/book_clinical_cases/JMD-Cases-of-Interest.pdf', 'data/tmp_files/pages_selection.txt']], myoutput=[['data/outputs/vignettes_selection1.json']])
+    
+    #batch mode: --myinput and --myoutput may be repeated, one output file per (book, selection) pair 
+    #and a single errors file collecting the errors of all pairs
+    if len(args.myinput) != len(args.myoutput):
+        parser.error("one --myoutput is expected for each --myinput")
+    if any([len(item) > 2 for item in args.myinput]):
+        parser.error("--myinput expects a book PDF and optionally a file of selected pages")
        
     #extract inputs into variables
-    book_pdf = args.myinput[0][0]
-    file_selected_pages = args.myinput[0][1] 
-    target_file = args.myoutput[0][0]
-    error_file = args.errors[0][0]
-    
-    
-    
-    #preprocess inputs
-    book_individual_pages = parse_pdf_content(book_pdf)
+    list_jobs = []
+    for item in args.myinput:
+        book_pdf = item[0]
+        file_selected_pages = item[1] if len(item) == 2 else None
+        
+        #preprocess inputs
+        list_pages_to_read = None
+        if file_selected_pages is not None:
+            with open(file_selected_pages, "r") as f:
+                list_pages_to_read_ = f.readlines() 
+            list_pages_to_read = [int(item) for item in list_pages_to_read_]
+        list_jobs.append((book_pdf, list_pages_to_read))
     
-    with open(file_selected_pages, "r") as f:
-        list_pages_to_read_ = f.readlines() 
-    list_pages_to_read = [int(item) for item in list_pages_to_read_]
+    list_target_files = [item[0] for item in args.myoutput]
+    error_file = args.errors[0][0]
     
     #apply processing
-    dict_results = extract_selected_cases(book_individual_pages, list_pages_to_read)
+    list_dict_results = extract_batch(list_jobs, pages_cache = args.pagescache, n_workers = args.workers, backend = args.pdfbackend)
     
     #dump outputs to json files
-    with open(target_file, "w") as fo:
-        json.dump(dict_results["vignettes"], fo)
+    list_errors = []
+    for (book_pdf, _), target_file, dict_results in zip(list_jobs, list_target_files, list_dict_results):
+        with open(target_file, "w") as fo:
+            json.dump(dict_results["vignettes"], fo)
+        
+        if len(list_jobs) > 1:
+            for error in dict_results["errors"]:
+                error.update({"book_pdf" : book_pdf, "output" : target_file})
+        list_errors.extend(dict_results["errors"])
 
     with open(error_file, "w") as fe:
-        json.dump(dict_results["errors"], fe)
+        json.dump(list_errors, fe)
     
     
 
@@ -0,0 +1,115 @@
+import xml.etree.ElementTree as ET
+import pandas as pd
+import sqlite3
+import zipfile
+import os
+import argparse
+
+DRUGBANK_NS = "{http://www.drugbank.ca}"
+
+
+def open_dump(dump_file):
+    """open the dump file, or the first file inside it when it is a zip archive"""
+    if dump_file.endswith(".zip"):
+        archive = zipfile.ZipFile(dump_file)
+        return archive.open(archive.namelist()[0])
+    return open(dump_file, "rb")
+
+
+def iterate_xml_interactions(dump_file):
+    """stream the drug-drug interactions out of the DrugBank XML database, without loading the whole file.
+    Yields (drug1_id, drug1_name, drug2_id, drug2_name, interaction) tuples"""
+    depth = 0
+    root = None
+
+    with open_dump(dump_file) as f:
+        for event, elem in ET.iterparse(f, events = ("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+
+            #only the drugs directly under the root element, not the ones referenced inside them
+            if (elem.tag != DRUGBANK_NS + "drug") or (depth != 1):
+                continue
+
+            list_ids = elem.findall(DRUGBANK_NS + "drugbank-id")
+            list_primary_ids = [item.text for item in list_ids if item.get("primary") == "true"]
+            drug1_id = list_primary_ids[0] if len(list_primary_ids) > 0 else list_ids[0].text
+            drug1_name = elem.findtext(DRUGBANK_NS + "name")
+
+            for interaction in elem.iterfind(DRUGBANK_NS + "drug-interactions/" + DRUGBANK_NS + "drug-interaction"):
+                yield (drug1_id, drug1_name,
+                       interaction.findtext(DRUGBANK_NS + "drugbank-id"),
+                       interaction.findtext(DRUGBANK_NS + "name"),
+                       interaction.findtext(DRUGBANK_NS + "description"))
+
+            #free the memory of the processed drug, and detach it from the root which would otherwise keep all the (emptied) drugs
+            root.clear()
+
+
+def iterate_csv_interactions(dump_file):
+    """read the interactions from a csv file with the columns of the interactions results:
+    drug1_id, drug1_name, drug2_id, drug2_name, interaction"""
+    for df_chunk in pd.read_csv(dump_file, chunksize = 100000):
+        for row in df_chunk[["drug1_id", "drug1_name", "drug2_id", "drug2_name", "interaction"]].itertuples(index = False):
+            yield tuple(row)
+
+
+def canonical_interaction(interaction):
+    """order the two drugs of an interaction by DrugBank ID, so that each pair is stored once"""
+    drug1_id, drug1_name, drug2_id, drug2_name, interaction_info = interaction
+    if drug2_id < drug1_id:
+        return (drug2_id, drug2_name, drug1_id, drug1_name, interaction_info)
+    return interaction
+
+
+def build_interactions_store(iter_interactions, target_file):
+    """write the interactions into an indexed SQLite table, pairs (drug1_id, drug2_id) being stored with drug1_id < drug2_id"""
+    if os.path.exists(target_file + ".tmp"):
+        os.remove(target_file + ".tmp")
+
+    con = sqlite3.connect(target_file + ".tmp")
+    con.execute("""CREATE TABLE interactions (drug1_id TEXT NOT NULL, drug1_name TEXT,
+                                              drug2_id TEXT NOT NULL, drug2_name TEXT,
+                                              interaction TEXT,
+                                              UNIQUE (drug1_id, drug2_id, interaction))""")
+    con.executemany("INSERT OR IGNORE INTO interactions VALUES (?, ?, ?, ?, ?)",
+                    (canonical_interaction(interaction) for interaction in iter_interactions))
+    #the unique constraint already indexes lookups by drug1_id and by (drug1_id, drug2_id)
+    con.execute("CREATE INDEX idx_interactions_drug2 ON interactions (drug2_id)")
+    con.commit()
+
+    nb_interactions = con.execute("SELECT COUNT(*) FROM interactions").fetchone()[0]
+    con.close()
+
+    os.replace(target_file + ".tmp", target_file)
+    return nb_interactions
+
+
+def main():
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--myinput', action='append', nargs=1)
+    parser.add_argument('--myoutput', action='append', nargs=1)
+    parser.add_argument('--dumpformat', default="xml", choices = ["xml", "csv"],
+                        help="xml: DrugBank full database (optionally zipped), csv: one interaction per row")
+    args = parser.parse_args()
+
+    #extract inputs into variables
+    dump_file = args.myinput[0][0]
+    target_file = args.myoutput[0][0]
+
+    if args.dumpformat == "xml":
+        iter_interactions = iterate_xml_interactions(dump_file)
+    else:
+        iter_interactions = iterate_csv_interactions(dump_file)
+
+    nb_interactions = build_interactions_store(iter_interactions, target_file)
+    print("stored {} drug-drug interactions in {}".format(nb_interactions, target_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,14 @@
+import spacy
 import pandas as pd
 import json
+import os
+import pickle
 import sys
 import argparse
 
+#bump when the structure of the compiled vocabulary changes
+COMPILED_VOCAB_VERSION = 2
+
 def preprocess_csv(zip_csv):
     """create dataframe from zipped csv file and project on columns of interest"""
 
@@ -11,9 +17,52 @@ def preprocess_csv(zip_csv):
     print("--------------------------------------------------")
     print(df_vocab.head(5))
     
-    #for this demo we ignore synonyms of the drugs names and adhere to their standard name (as is also used in the book)
-    df_projected = df_vocab[["DrugBank ID", "Common name"]]
+    #the JSON vocabulary ignores synonyms of the drugs names and adheres to their standard name (as is also used in the book),
+    #synonyms are only kept in the compiled vocabulary
+    df_projected = df_vocab[["DrugBank ID", "Common name", "Synonyms"]]
     return df_projected
+
+
+def medication_tokens_key(tokens):
+    """lookup key of a medication name from its tokens (a Doc or Span), independent of case and of the whitespace between tokens"""
+    return " ".join([tok.lower_ for tok in tokens])
+
+
+def compile_vocab(df_drugbank):
+    """build the compiled vocabulary: parallel lists of DrugBank IDs, common names and synonyms, 
+       and a normalized name -> id map (common names take precedence over synonyms). Names are normalized 
+       as the phrase matcher of bner_drugbank.py looks them up, from their tokens by the English tokenizer, 
+       so that the map is its index. Strings are interned so each one is stored once in the pickle"""
+    drugbank_ids = [sys.intern(str(item)) for item in df_drugbank["DrugBank ID"]]
+    names = [sys.intern(str(item)) for item in df_drugbank["Common name"]]
+    synonyms = [[sys.intern(syn.strip()) for syn in str(item).split("|") if syn.strip() != ""] if pd.notna(item) else [] 
+                for item in df_drugbank["Synonyms"]]
+    
+    list_entries = list(zip(drugbank_ids, names)) + [(drugbank_id, syn) for drugbank_id, list_synonyms in zip(drugbank_ids, synonyms) 
+                                                      for syn in list_synonyms]
+    tokenizer = spacy.blank("en").tokenizer
+    
+    name_to_id = {}
+    for (drugbank_id, _), tokens in zip(list_entries, tokenizer.pipe([name for _, name in list_entries], batch_size = 1000)):
+        name_to_id.setdefault(sys.intern(medication_tokens_key(tokens)), drugbank_id)
+    
+    compiled_vocab = {"version" : COMPILED_VOCAB_VERSION,
+                      "drugbank_ids" : drugbank_ids,
+                      "names" : names,
+                      "synonyms" : synonyms,
+                      "name_to_id" : name_to_id}
+    return compiled_vocab
+
+
+def load_compiled_vocab(compiled_file):
+    """load the compiled vocabulary written by this script"""
+    with open(compiled_file, "rb") as f:
+        compiled_vocab = pickle.load(f)
+    
+    if compiled_vocab.get("version") != COMPILED_VOCAB_VERSION:
+        raise ValueError("compiled vocabulary {} has version {}, expected {}. Run preprocess_drugbank_vocab.py again".format(
+                         compiled_file, compiled_vocab.get("version"), COMPILED_VOCAB_VERSION))
+    return compiled_vocab
     
 
 def main():
@@ -21,16 +70,22 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--myinput', action='append', nargs=1)
     parser.add_argument('--myoutput', action='append', nargs=1)
+    parser.add_argument('--mycompiled', action='append', nargs=1, help="compiled vocabulary file, by default the JSON output path with .pkl extension")
     args = parser.parse_args()
     
     #extract inputs into variables
     zip_csv = args.myinput[0][0]
     target_file = args.myoutput[0][0]
+    compiled_file = args.mycompiled[0][0] if args.mycompiled is not None else os.path.splitext(target_file)[0] + ".pkl"
     
     df_drugbank = preprocess_csv(zip_csv)
     
     #dump output to json file
-    df_drugbank.to_json(target_file, orient = "records")
+    df_drugbank[["DrugBank ID", "Common name"]].to_json(target_file, orient = "records")
+    
+    #dump the compiled vocabulary, which the medication stages load in milliseconds
+    with open(compiled_file, "wb") as fo:
+        pickle.dump(compile_vocab(df_drugbank), fo, protocol = pickle.HIGHEST_PROTOCOL)
 
 if __name__ == '__main__':
     main()
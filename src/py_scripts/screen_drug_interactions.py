@@ -0,0 +1,141 @@
+import numpy as np
+import sqlite3
+import json
+import time
+import os
+import itertools
+import argparse
+
+
+def interaction_index_file(store_file):
+    """the adjacency index is saved next to the interactions store it is built from"""
+    return os.path.splitext(store_file)[0] + "_adjacency.npz"
+
+
+def build_interaction_index(store_file):
+    """build the symmetric interaction graph of the DrugBank IDs in the interactions store, in CSR form:
+    the neighbours of the drug ids[i] are ids[indices[indptr[i]:indptr[i+1]]], sorted"""
+    con = sqlite3.connect("file:{}?mode=ro".format(store_file), uri = True)
+    rows = con.execute("""SELECT drug1_id, MIN(drug1_name), drug2_id, MIN(drug2_name) FROM interactions
+                          GROUP BY drug1_id, drug2_id""").fetchall()
+    con.close()
+
+    dict_names = {}
+    for drug1_id, drug1_name, drug2_id, drug2_name in rows:
+        dict_names[drug1_id] = drug1_name
+        dict_names[drug2_id] = drug2_name
+    ids = np.array(sorted(dict_names.keys()))
+    names = np.array([dict_names[drugbank_id] or "" for drugbank_id in ids])
+
+    #both directions of each pair, sorted by row then column
+    src = np.searchsorted(ids, np.array([row[0] for row in rows]))
+    dst = np.searchsorted(ids, np.array([row[2] for row in rows]))
+    edges = np.unique(np.concatenate([src * len(ids) + dst, dst * len(ids) + src]))
+
+    indptr = np.searchsorted(edges // len(ids), np.arange(len(ids) + 1))
+    indices = (edges % len(ids)).astype(np.int32)
+    return {"ids" : ids, "names" : names, "indptr" : indptr, "indices" : indices}
+
+
+def save_interaction_index(index, index_file):
+    np.savez(index_file, **index)
+    return
+
+
+def load_interaction_index(store_file):
+    """load the adjacency index of the interactions store, building it first when missing or older than the store"""
+    index_file = interaction_index_file(store_file)
+    if (not os.path.exists(index_file)) or (os.path.getmtime(index_file) < os.path.getmtime(store_file)):
+        save_interaction_index(build_interaction_index(store_file), index_file)
+
+    with np.load(index_file) as f:
+        index = {key : f[key] for key in f.files}
+    return index
+
+
+def vignettes_medication_ids(list_cases, parts = ("question",)):
+    """set of the DrugBank IDs annotated by bner_drugbank.py in the given parts of each vignette"""
+    return [set([item["drugbank_id"] for part in parts for item in vignette["bner_" + part]]) for vignette in list_cases]
+
+
+def screen_interacting_pairs(index, list_medication_ids):
+    """find the interacting pairs among the medication of each vignette of the corpus in one pass:
+    all the candidate pairs of the corpus are looked up at once among the sorted edges of the graph.
+    Returns, for each vignette, the list of its interacting pairs (drug1_id, drug2_id) with drug1_id < drug2_id"""
+    ids = index["ids"]
+    nb_ids = len(ids)
+
+    #edge keys row * nb_ids + column are sorted, since CSR rows and the columns within each row are
+    rows = np.repeat(np.arange(nb_ids, dtype = np.int64), np.diff(index["indptr"]))
+    edges = rows * nb_ids + index["indices"]
+
+    #candidate pairs of the drugs of each vignette known to the graph, as (vignette, row, column) with row < column
+    dict_pos = {drugbank_id : pos for pos, drugbank_id in enumerate(ids.tolist())}
+    list_vignette_pos = []
+    list_pairs = []
+    for i, set_ids in enumerate(list_medication_ids):
+        list_pos = sorted([dict_pos[drugbank_id] for drugbank_id in set_ids if drugbank_id in dict_pos])
+        for pair_pos in itertools.combinations(list_pos, 2):
+            list_vignette_pos.append(i)
+            list_pairs.append(pair_pos)
+
+    if len(list_pairs) == 0:
+        return [[] for _ in list_medication_ids]
+
+    vignette_pos = np.array(list_vignette_pos)
+    pairs = np.array(list_pairs, dtype = np.int64)
+    keys = pairs[:, 0] * nb_ids + pairs[:, 1]
+
+    found = np.searchsorted(edges, keys)
+    interacting = (found < len(edges)) & (edges[np.minimum(found, len(edges) - 1)] == keys)
+
+    list_results = [[] for _ in list_medication_ids]
+    for i, (pos1, pos2) in zip(vignette_pos[interacting], pairs[interacting]):
+        list_results[i].append((str(ids[pos1]), str(ids[pos2])))
+    return list_results
+
+
+def main():
+
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--myinput', action='append', nargs=1, help="medication annotated by bner_drugbank.py")
+    parser.add_argument('--myoutput', action='append', nargs=1)
+    parser.add_argument('--ddistore', required=True, help="SQLite interactions store built by preprocess_drugbank_interactions.py")
+    parser.add_argument('--parts', nargs='+', default=["question"], choices=["question", "answer"],
+                        help="parts of the vignettes whose medication is screened together")
+    args = parser.parse_args()
+
+    #extract inputs into variables
+    medication_json = args.myinput[0][0]
+    target_file = args.myoutput[0][0]
+
+    with open(medication_json) as f:
+        list_cases = json.load(f)
+
+    time_start = time.perf_counter()
+    index = load_interaction_index(args.ddistore)
+    load_time = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    list_screened = screen_interacting_pairs(index, vignettes_medication_ids(list_cases, args.parts))
+    screen_time = time.perf_counter() - time_start
+
+    dict_names = dict(zip(index["ids"].tolist(), index["names"].tolist()))
+    list_results = []
+    for vignette, list_pairs in zip(list_cases, list_screened):
+        list_results.append({"book_page" : vignette["book_page"],
+                             "interacting_pairs" : [{"drug1_id" : drug1_id, "drug1_name" : dict_names[drug1_id],
+                                                     "drug2_id" : drug2_id, "drug2_name" : dict_names[drug2_id]}
+                                                    for drug1_id, drug2_id in list_pairs]})
+
+    print("screened {} vignettes in {:.3f}s (index loaded in {:.3f}s): {} with interacting medication".format(
+          len(list_cases), screen_time, load_time, len([item for item in list_results if len(item["interacting_pairs"]) > 0])))
+
+    #dump outputs to json files
+    with open(target_file, "w") as fo:
+        json.dump(list_results, fo)
+
+
+if __name__ == '__main__':
+    main()
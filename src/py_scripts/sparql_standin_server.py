@@ -0,0 +1,121 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import sqlite3
+import json
+import re
+import time
+import threading
+import argparse
+
+#local stand-in of the Bio2RDF SPARQL endpoint for tests, answering the interactions queries of
+#drugdrug_interactions_drugbank.py from the SQLite store built by preprocess_drugbank_interactions.py
+
+store_file = None
+#failures on demand, to exercise the retries, backoff and timeouts of the client:
+#the first fail_count requests are answered with fail_status, every request is delayed by delay seconds
+fail_count = 0
+fail_status = 503
+delay = 0.0
+nb_requests = 0
+requests_lock = threading.Lock()
+
+
+def parse_values_clause(qq, variable):
+    """DrugBank IDs listed in the VALUES clause of a variable of the query, None when there is no such clause"""
+    match = re.search(r"VALUES\s+\?" + variable + r"\s*\{([^}]*)\}", qq)
+    if match is None:
+        return None
+    return [item.split(":", 1)[1] for item in match.group(1).split()]
+
+
+def binding(drug1_id, drug1_name, drug2_id, drug2_name, interaction_info):
+    """one result binding with the variables selected by the interactions query"""
+    return {"d1_str" : {"type" : "literal", "value" : drug1_id},
+            "drug1_label_str" : {"type" : "literal", "value" : drug1_name},
+            "d2_str" : {"type" : "literal", "value" : drug2_id},
+            "drug2_label_str" : {"type" : "literal", "value" : drug2_name},
+            "titleddi_str" : {"type" : "literal", "value" : interaction_info}}
+
+
+def answer_interactions_query(qq):
+    """SPARQL results json of the interactions between the drugs of the ?db_drug1 and ?db_drug2 VALUES clauses"""
+    list_ids1 = parse_values_clause(qq, "db_drug1") or []
+    list_ids2 = parse_values_clause(qq, "db_drug2")
+
+    con = sqlite3.connect("file:{}?mode=ro".format(store_file), uri = True)
+    list_bindings = []
+
+    for drugbank_id1 in list_ids1:
+        rows = con.execute("""SELECT drug1_id, drug1_name, drug2_id, drug2_name, interaction FROM interactions
+                              WHERE drug1_id = ? OR drug2_id = ?""", (drugbank_id1, drugbank_id1)).fetchall()
+        for drug1_id, drug1_name, drug2_id, drug2_name, interaction_info in rows:
+            #the store holds each pair once, report it with the queried drug as drug1
+            if drug1_id != drugbank_id1:
+                drug1_id, drug1_name, drug2_id, drug2_name = drug2_id, drug2_name, drug1_id, drug1_name
+            if (list_ids2 is None) or (drug2_id in list_ids2):
+                list_bindings.append(binding(drug1_id, drug1_name, drug2_id, drug2_name, interaction_info))
+
+    con.close()
+
+    res_json = {"head" : {"link" : [], "vars" : ["d1_str", "drug1_label_str", "d2_str", "drug2_label_str", "titleddi_str"]},
+                "results" : {"distinct" : True, "ordered" : True, "bindings" : list_bindings}}
+    return res_json
+
+
+class SparqlStandinHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        global nb_requests
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+
+        if (url.path != "/sparql") or ("query" not in params):
+            self.send_error(404)
+            return
+
+        with requests_lock:
+            nb_requests += 1
+            request_number = nb_requests
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if request_number <= fail_count:
+            self.send_error(fail_status)
+            return
+
+        body = json.dumps(answer_interactions_query(params["query"][0])).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/sparql-results+json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    global store_file
+    global fail_count
+    global fail_status
+    global delay
+
+    #parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ddistore', required=True, help="SQLite interactions store answering the queries")
+    parser.add_argument('--port', type=int, default=8890)
+    parser.add_argument('--failcount', type=int, default=0, help="number of first requests answered with --failstatus")
+    parser.add_argument('--failstatus', type=int, default=503, help="status of the failed requests, e.g. 429, 500, 503 or 400")
+    parser.add_argument('--delay', type=float, default=0.0, help="seconds before answering each request")
+    args = parser.parse_args()
+
+    store_file = args.ddistore
+    fail_count = args.failcount
+    fail_status = args.failstatus
+    delay = args.delay
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), SparqlStandinHandler)
+    print("SPARQL stand-in listening on http://127.0.0.1:{}/sparql".format(args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()